@@ -2,6 +2,7 @@ import sys
 
 from django.apps import AppConfig as DjangoAppConfig
 
+from edc_rule_groups.predicate_stats import predicate_stats
 from edc_rule_groups.site_rule_groups import site_rule_groups
 from django.core.management.color import color_style
 
@@ -11,11 +12,21 @@ style = color_style()
 class AppConfig(DjangoAppConfig):
     name = 'edc_rule_groups'
     verbose_name = 'Edc Rule Groups'
+    predicate_stats_file = None  # JSON file of statistics to order And/Or predicates by
+    track_changes = False  # if True, skip rules whose source model fields did not change in a save
 
     def ready(self):
         sys.stdout.write('Loading {} ...\n'.format(self.verbose_name))
+        site_rule_groups.track_changes = self.track_changes
         site_rule_groups.autodiscover()
         if not site_rule_groups.registry:
             sys.stdout.write(style.ERROR(
                 ' Warning. No rule groups have loaded.\n'.format(self.verbose_name)))
+        for cycle in site_rule_groups.get_cycles():
+            sys.stdout.write(style.ERROR(
+                ' Warning. Rule groups have a cycle of source and target models: {}\n'.format(
+                    ' -> '.join('.'.join(key) for key in cycle + cycle[:1]))))
+        if self.predicate_stats_file:
+            predicate_stats.load(self.predicate_stats_file)
+            sys.stdout.write(' * ordering predicates by {}\n'.format(self.predicate_stats_file))
         sys.stdout.write(' Done loading {}.\n'.format(self.verbose_name))
@@ -5,14 +5,63 @@ from .rule import Rule
 
 class VisitScheduleRule(Rule):
 
+    """A rule that runs only for the visits of a schedule with one of
+    its visit codes.
+
+    The visit codes are resolved from the visit schedule once and again
+    if a visit schedule is registered or replaced. Call
+    `schedules_changed` after changing a registered schedule in place.
+
+    Set `visit_schedule_name` and `schedule_name` on a subclass.
+    """
+
+    schedules_version = 0
+
     visit_schedule_name = None
     schedule_name = None
-    visit_codes = None
+
+    __slots__ = ('visit_codes', 'visit_schedule', 'schedule', '_visit_code_set', '_registry_token')
 
     def __init__(self, visit_schedule_name=None, schedule_name=None,
                  visit_codes=None, **kwargs):
         super().__init__(**kwargs)
+        self.visit_schedule = None
+        self.schedule = None
         self.visit_codes = visit_codes
+        self.invalidate()
+
+    def invalidate(self):
+        """Clears the cached visit codes."""
+        self._visit_code_set = None
+        self._registry_token = None
+
+    @classmethod
+    def schedules_changed(cls):
+        """Clears the cached visit codes of every rule."""
+        VisitScheduleRule.schedules_version += 1
+
+    @classmethod
+    def get_registry_token(cls):
+        """Returns a value that changes when the visit schedule registry
+        changes or schedules_changed is called."""
+        registry = getattr(site_visit_schedules, 'registry', None)
+        try:
+            size = len(registry)
+        except TypeError:
+            size = None
+        return (id(registry), size, VisitScheduleRule.schedules_version)
+
+    @property
+    def visit_code_set(self):
+        """Returns a frozenset of the codes of the visits the rule applies to.
+
+        Resolved from the visit schedule once and again only if the
+        visit schedule registry changes."""
+        registry_token = self.get_registry_token()
+        if self._visit_code_set is None or registry_token != self._registry_token:
+            self._visit_code_set = frozenset(visit.code for visit in self.visits)
+            self._registry_token = registry_token
+        return self._visit_code_set
 
     @property
     def visits(self):
@@ -27,11 +76,13 @@ class VisitScheduleRule(Rule):
         return visits
 
     def runif(self, visit, **kwargs):
-        return True if visit.visit_code in [visit.code for visit in self.visits] else False
+        return visit.visit_code in self.visit_code_set
 
 
 class CrfRule(VisitScheduleRule):
 
+    __slots__ = ()
+
     def __init__(self, target_models, visit_codes=None, **kwargs):
         super().__init__(target_models, visit_codes, **kwargs)
         self.rule_type = 'crf'
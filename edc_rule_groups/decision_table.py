@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+from .exceptions import RuleError
+from .predicate import P
+
+
+class DecisionTable:
+
+    """A lookup table of the entry_statuses decided by the rules of a rule
+    group whose predicates test the same attr for equality.
+
+    For example, rules with predicates P('f1', 'eq', 'car') and
+    P('f1', 'eq', 'bicycle') are decided by reading f1 once and looking
+    up its value instead of evaluating each predicate.
+    """
+
+    operators = ['eq', 'equals', '==']
+
+    def __init__(self, attr, rules):
+        self.attr = attr
+        self.rules = tuple(rules)
+        self.predicate = self.rules[0].logic.predicate
+        self.default = tuple(rule.get_result(False) for rule in self.rules)
+        self.table = {}
+        for rule in self.rules:
+            value = rule.logic.predicate.expected_value
+            if value not in self.table:
+                self.table[value] = tuple(
+                    r.get_result(value == r.logic.predicate.expected_value) for r in self.rules)
+
+    def __repr__(self):
+        return '<{}({}, {} rules)>'.format(self.__class__.__name__, self.attr, len(self.rules))
+
+    @classmethod
+    def is_tabular(cls, rule):
+        """Returns True if the rule's predicate tests one attr for equality
+        with a hashable value."""
+        predicate = rule.logic.predicate
+        if type(predicate) is not P or predicate.operator not in cls.operators:
+            return False
+        try:
+            hash(predicate.expected_value)
+        except TypeError:
+            return False
+        return True
+
+    @classmethod
+    def compile(cls, rules):
+        """Returns a list of tables for the rules, one for each attr
+        tested by more than one tabular rule."""
+        rules_by_attr = OrderedDict()
+        for rule in rules:
+            if cls.is_tabular(rule):
+                rules_by_attr.setdefault(rule.logic.predicate.attr, []).append(rule)
+        return [cls(attr, rules) for attr, rules in rules_by_attr.items() if len(rules) > 1]
+
+    @classmethod
+    def attach(cls, rules):
+        """Compiles the tables for the rules, sets the `decision_table` of
+        each rule to its table or None and returns the tables."""
+        decision_tables = cls.compile(rules)
+        for rule in rules:
+            rule.decision_table = None
+        for decision_table in decision_tables:
+            for rule in decision_table.rules:
+                rule.decision_table = decision_table
+        return decision_tables
+
+    def evaluate(self, *args):
+        """Returns a dictionary of {rule: entry_status} for the predicate args.
+
+        Row for row the same result as evaluating each rule."""
+        try:
+            value = self.predicate.get_value(*args, attr=self.attr)
+        except Exception as e:
+            raise RuleError('An exception was raised when running rules {}. Got {}'.format(
+                list(self.rules), str(e)))
+        try:
+            entry_statuses = self.table.get(value, self.default)
+        except TypeError:
+            entry_statuses = tuple(
+                rule.get_result(value == rule.logic.predicate.expected_value) for rule in self.rules)
+        return dict(zip(self.rules, entry_statuses))
@@ -0,0 +1,89 @@
+import threading
+
+from django.db.models.signals import post_init, post_save, pre_delete, pre_save
+
+
+class FieldTracker:
+
+    """Tracks which fields of a source model instance changed in a save.
+
+    Field values are recorded when an instance is loaded and after each
+    save. On pre_save the current values are compared to the record and
+    the names of the changed fields are kept on the instance until the
+    next save. `changed_fields` returns None for new instances and for
+    instances of models that are not tracked.
+
+    Recording costs a copy of the field values of every instance loaded,
+    so models are only tracked if `site_rule_groups.track_changes` is
+    True. The instance of each model being saved in a thread is kept
+    from pre_save until post_save for `pop_saved`, so post_save receivers
+    connected before the tracker, such as the one running the rules,
+    find the instance of the current save.
+    """
+
+    initial_attr = '_rule_groups_initial_values'
+    changed_attr = '_rule_groups_changed_fields'
+
+    def __init__(self):
+        self.models = set()
+        self._thread = threading.local()
+
+    def track(self, model):
+        """Connects the signals that track changes for instances of model."""
+        if model in self.models:
+            return
+        uid = 'edc_rule_groups.field_tracker.{}'.format(model._meta.label_lower)
+        post_init.connect(self.on_post_init, sender=model, weak=False, dispatch_uid=uid)
+        pre_save.connect(self.on_pre_save, sender=model, weak=False, dispatch_uid=uid)
+        post_save.connect(self.on_post_save, sender=model, weak=False, dispatch_uid=uid)
+        pre_delete.connect(self.on_pre_delete, sender=model, weak=False, dispatch_uid=uid)
+        self.models.add(model)
+
+    def get_values(self, instance):
+        """Returns a dictionary of the loaded field values of instance
+        without fetching deferred fields."""
+        return {
+            field.name: instance.__dict__[field.attname]
+            for field in instance._meta.concrete_fields
+            if field.attname in instance.__dict__}
+
+    def on_post_init(self, instance, **kwargs):
+        instance.__dict__[self.initial_attr] = self.get_values(instance)
+
+    def on_pre_save(self, instance, raw=None, **kwargs):
+        if instance._state.adding or raw:
+            changed_fields = None
+        else:
+            initial_values = instance.__dict__.get(self.initial_attr, {})
+            changed_fields = set(
+                name for name, value in self.get_values(instance).items()
+                if name not in initial_values or initial_values[name] != value)
+        instance.__dict__[self.changed_attr] = changed_fields
+        self.saved[instance.__class__] = instance
+
+    def on_post_save(self, instance, **kwargs):
+        instance.__dict__[self.initial_attr] = self.get_values(instance)
+        self.saved.pop(instance.__class__, None)
+
+    def on_pre_delete(self, instance, **kwargs):
+        instance.__dict__[self.changed_attr] = None
+
+    @property
+    def saved(self):
+        try:
+            return self._thread.saved
+        except AttributeError:
+            self._thread.saved = {}
+            return self._thread.saved
+
+    def pop_saved(self, model):
+        """Returns the instance of model being saved in this thread, once, or None."""
+        return self.saved.pop(model, None)
+
+    def changed_fields(self, instance):
+        """Returns a set of the names of the fields changed in the last
+        save of instance or None if not known."""
+        return instance.__dict__.get(self.changed_attr)
+
+
+field_tracker = FieldTracker()
@@ -6,15 +6,18 @@ from .exceptions import RuleError
 
 class Logic(object):
 
+    __slots__ = ('predicate', 'consequence', 'alternative', 'comment', '_attrs')
+
     valid_results = [REQUIRED, NOT_REQUIRED, DO_NOTHING]
 
-    def __init__(self, predicate=None, consequence=None, alternative=None, comment=None):
+    def __init__(self, predicate=None, consequence=None, alternative=None, comment=None, attrs=None):
         if not hasattr(predicate, '__call__'):
             raise RuleError('Predicate must be a callable.')
         self.predicate = predicate
         self.consequence = consequence
         self.alternative = alternative
         self.comment = comment
+        self._attrs = tuple(attrs) if attrs is not None else None
         for result in [self.consequence, self.alternative]:
             if result not in self.valid_results:
                 raise RuleError(
@@ -23,6 +26,15 @@ class Logic(object):
     def __repr__(self):
         return '<{}({}, {}, {})>'.format(self.__class__.__name__, self.predicate, self.consequence, self.alternative)
 
+    @property
+    def attrs(self):
+        """Returns a tuple of the attrs read by the predicate or None if not known.
+
+        Pass `attrs` to declare the attrs read by a function predicate."""
+        if self._attrs is not None:
+            return self._attrs
+        return getattr(self.predicate, 'attrs', None)
+
     @property
     def __doc__(self):
         return ('{0}. If True sets \'{{target_model}}\' to \'{1.consequence}\' otherwise \'{1.alternative}\'. '
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from edc_rule_groups.queues import DatabaseQueue
+
+
+class Command(BaseCommand):
+
+    help = 'Runs the rules for the visits queued in the RuleJob table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', action='store_true', dest='loop', default=False,
+            help='Keep polling the queue instead of exiting when it is empty.')
+        parser.add_argument(
+            '--sleep', type=float, default=1.0, dest='sleep',
+            help='Seconds to wait between polls with --loop. (default: 1.0)')
+
+    def handle(self, *args, **options):
+        queue = DatabaseQueue()
+        while True:
+            started = time.time()
+            count = queue.process()
+            if count:
+                self.stdout.write('  ran {} queued visits ({:.1f} visits/s).'.format(
+                    count, count / max(time.time() - started, 1e-6)))
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
@@ -0,0 +1,124 @@
+import json
+import os
+import time
+
+from contextlib import contextmanager
+from django.apps import apps as django_apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from edc_rule_groups.parallel import update_parallel
+from edc_rule_groups.predicate_stats import predicate_stats
+from edc_rule_groups.site_rule_groups import site_rule_groups
+
+
+class Command(BaseCommand):
+
+    help = ('Runs all rule groups for every existing instance of a visit model, '
+            'e.g. after a protocol amendment.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'visit_model', help='The visit model label, e.g. edc_example.subjectvisit')
+        parser.add_argument(
+            '--chunk-size', type=int, default=500, dest='chunk_size',
+            help='Number of visits updated per transaction. (default: 500)')
+        parser.add_argument(
+            '--checkpoint', dest='checkpoint',
+            help=('File to record the last visit updated. If the file exists the update '
+                  'resumes after that visit. The file is removed when the update completes.'))
+        parser.add_argument(
+            '--workers', type=int, default=0, dest='workers',
+            help=('Number of processes to shard subjects across. Requires a database '
+                  'that can be shared between processes. (default: run serially)'))
+        parser.add_argument(
+            '--benchmark', action='store_true', dest='benchmark', default=False,
+            help='With --workers, run with 1 to WORKERS processes and report the speed-up.')
+        parser.add_argument(
+            '--predicate-stats', dest='predicate_stats',
+            help=('File to save the time taken by and the results of the sub-predicates of '
+                  'And/Or predicates to. Load the file to order sub-predicates by it.'))
+
+    def handle(self, *args, **options):
+        try:
+            visit_model = django_apps.get_model(*options['visit_model'].split('.'))
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        chunk_size = options['chunk_size']
+        checkpoint = options['checkpoint']
+        if options['workers']:
+            if checkpoint:
+                raise CommandError('Option --checkpoint cannot be used with --workers.')
+            if options['predicate_stats']:
+                raise CommandError('Option --predicate-stats cannot be used with --workers.')
+            return self.handle_parallel(visit_model, options['workers'], chunk_size, options['benchmark'])
+        last_pk = self.read_checkpoint(checkpoint, visit_model)
+        if last_pk is not None:
+            self.stdout.write('Resuming after {} {}.'.format(visit_model._meta.label_lower, last_pk))
+        queryset = visit_model.objects.order_by('pk')
+        total = 0
+        evaluations = 0
+        started = time.time()
+        with self.collect_predicate_stats(options['predicate_stats']):
+            while True:
+                chunk_started = time.time()
+                chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                visits = list(chunk[:chunk_size])
+                if not visits:
+                    break
+                with transaction.atomic():
+                    contexts = site_rule_groups.update_many(visits)
+                last_pk = visits[-1].pk
+                self.write_checkpoint(checkpoint, visit_model, last_pk)
+                total += len(visits)
+                evaluations += sum(context.predicate_evaluations for context in contexts)
+                self.stdout.write('  updated {} visits ({:.1f} visits/s).'.format(
+                    total, len(visits) / max(time.time() - chunk_started, 1e-6)))
+        elapsed = time.time() - started
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write(self.style.SUCCESS(
+            'Done. Updated {} visits in {:.1f}s ({:.1f} visits/s, {} predicate evaluations).'.format(
+                total, elapsed, total / max(elapsed, 1e-6), evaluations)))
+
+    def handle_parallel(self, visit_model, workers, chunk_size, benchmark):
+        timings = {}
+        for n in (range(1, workers + 1) if benchmark else [workers]):
+            total, elapsed = update_parallel(visit_model._meta.label_lower, n, chunk_size)
+            timings[n] = elapsed
+            self.stdout.write(
+                '  {} worker(s): updated {} visits in {:.1f}s ({:.1f} visits/s, speed-up {:.2f}x).'.format(
+                    n, total, elapsed, total / max(elapsed, 1e-6),
+                    timings[min(timings)] / max(elapsed, 1e-6)))
+        self.stdout.write(self.style.SUCCESS('Done.'))
+
+    @contextmanager
+    def collect_predicate_stats(self, path):
+        """Collects the predicate statistics while updating and, if the
+        update completes, saves them to `path`. Does nothing if `path` is None."""
+        if not path:
+            yield
+            return
+        predicate_stats.clear()
+        predicate_stats.enabled = True
+        try:
+            yield
+        finally:
+            predicate_stats.enabled = False
+        predicate_stats.save(path)
+
+    def read_checkpoint(self, checkpoint, visit_model):
+        """Returns the pk of the last visit updated or None."""
+        if not checkpoint or not os.path.exists(checkpoint):
+            return None
+        with open(checkpoint) as f:
+            data = json.load(f)
+        if data.get('visit_model') != visit_model._meta.label_lower:
+            raise CommandError('Checkpoint {} is for {}. Got {}.'.format(
+                checkpoint, data.get('visit_model'), visit_model._meta.label_lower))
+        return data.get('last_pk')
+
+    def write_checkpoint(self, checkpoint, visit_model, last_pk):
+        if checkpoint:
+            with open(checkpoint, 'w') as f:
+                json.dump({'visit_model': visit_model._meta.label_lower, 'last_pk': str(last_pk)}, f)
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+
+from django.apps import apps as django_apps
+from django.db.models import Case, F, Q, Value, When
+
+
+class MetadataWriter:
+
+    """Collects metadata entry_status updates and writes them in bulk.
+
+    Updates are keyed on (subject_identifier, visit_code, model, panel_name)
+    so a later update for the same metadata row replaces an earlier one,
+    the same result as writing each update in sequence. `flush` issues one
+    UPDATE per metadata model for each `batch_size` rows, so the size of a
+    statement does not grow with the number of rows collected.
+
+    Updates with an entry_status of None (DO_NOTHING) are not collected.
+    """
+
+    crf_metadata_model = 'edc_metadata.crfmetadata'
+    requisition_metadata_model = 'edc_metadata.requisitionmetadata'
+    batch_size = 100
+
+    def __init__(self):
+        self.updates = OrderedDict()
+
+    def __repr__(self):
+        return '<{}({} pending)>'.format(self.__class__.__name__, len(self.updates))
+
+    def __len__(self):
+        return len(self.updates)
+
+    def update(self, visit, model, entry_status=None, panel_name=None):
+        """Collects an entry_status for a model (and panel) of the visit."""
+        if entry_status is None:
+            return
+        key = (visit.subject_identifier, visit.visit_code, model, panel_name)
+        self.updates.pop(key, None)
+        self.updates[key] = entry_status
+
+    def flush(self):
+        """Writes all collected updates and returns the number of rows updated."""
+        crf_updates = OrderedDict()
+        requisition_updates = OrderedDict()
+        for key, entry_status in self.updates.items():
+            if key[3] is None:
+                crf_updates[key] = entry_status
+            else:
+                requisition_updates[key] = entry_status
+        self.updates = OrderedDict()
+        updated = 0
+        if crf_updates:
+            updated += self._bulk_update(self.crf_metadata_model, crf_updates)
+        if requisition_updates:
+            updated += self._bulk_update(self.requisition_metadata_model, requisition_updates)
+        return updated
+
+    def _bulk_update(self, metadata_model, updates):
+        """Updates the entry_status of each metadata row in `updates`
+        in one UPDATE statement for each `batch_size` rows."""
+        model_cls = django_apps.get_model(*metadata_model.split('.'))
+        updates = list(updates.items())
+        updated = 0
+        for index in range(0, len(updates), self.batch_size):
+            updated += self._update_batch(model_cls, updates[index:index + self.batch_size])
+        return updated
+
+    def _update_batch(self, model_cls, updates):
+        """Updates the entry_status of each metadata row in `updates`, a
+        list of (key, entry_status), in a single UPDATE statement."""
+        condition = Q()
+        whens = []
+        for (subject_identifier, visit_code, model, panel_name), entry_status in updates:
+            lookup = dict(subject_identifier=subject_identifier, visit_code=visit_code, model=model)
+            if panel_name is not None:
+                lookup.update(panel_name=panel_name)
+            condition |= Q(**lookup)
+            whens.append(When(then=Value(entry_status), **lookup))
+        return model_cls.objects.filter(condition).update(
+            entry_status=Case(
+                *whens, default=F('entry_status'),
+                output_field=model_cls._meta.get_field('entry_status')))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RuleJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('visit_model', models.CharField(max_length=100)),
+                ('visit_pk', models.CharField(max_length=50)),
+                ('source_models', models.TextField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='rulejob',
+            unique_together=set([('visit_model', 'visit_pk')]),
+        ),
+    ]
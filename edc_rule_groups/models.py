@@ -0,0 +1,29 @@
+from django.db import models
+
+
+class RuleJob(models.Model):
+
+    """A pending request to run the rules for a visit, used by
+    edc_rule_groups.queues.DatabaseQueue.
+
+    One row per visit; `source_models` is a comma separated list of
+    source model labels or null for all rules. `error` is set if running
+    the rules raised."""
+
+    visit_model = models.CharField(max_length=100)
+
+    visit_pk = models.CharField(max_length=50)
+
+    source_models = models.TextField(null=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    error = models.TextField(null=True)
+
+    def __str__(self):
+        return '{} {}'.format(self.visit_model, self.visit_pk)
+
+    class Meta:
+        app_label = 'edc_rule_groups'
+        ordering = ('id', )
+        unique_together = ('visit_model', 'visit_pk')
@@ -0,0 +1,92 @@
+"""Runs all rule groups for every visit of a cohort in a process pool.
+
+Subjects are sharded across the workers so that all visits of a
+subject are updated by the same worker. Each worker opens its own
+database connection and uses the `site_rule_groups` registry populated
+when Django was set up. Visits are independent of one another so the
+result is the same as a serial run.
+
+A database shared between processes is required, so an in-memory
+SQLite test database cannot be used.
+
+Visits are selected for at most `subject_batch_size` subjects per query
+to stay within the database's limit on query parameters, e.g. 999 for
+older SQLite.
+"""
+import multiprocessing
+import time
+
+import django
+
+from django.apps import apps as django_apps
+from django.db import connections, transaction
+
+from .site_rule_groups import site_rule_groups
+
+subject_batch_size = 500
+
+
+def init_worker():
+    """Sets up Django in the worker if needed and closes any database
+    connection inherited from the parent so the worker opens its own."""
+    if not django_apps.ready:
+        django.setup()
+    connections.close_all()
+
+
+def get_shards(subject_identifiers, workers):
+    """Returns a list of `workers` lists of subject identifiers."""
+    subject_identifiers = sorted(subject_identifiers)
+    return [subject_identifiers[index::workers] for index in range(workers)]
+
+
+def update_shard(visit_model, subject_identifiers, chunk_size=500):
+    """Runs all rule groups for the visits of the subjects in chunks of
+    `chunk_size` visits. Returns the number of visits updated."""
+    model = django_apps.get_model(*visit_model.split('.'))
+    subject_identifiers = sorted(subject_identifiers)
+    total = 0
+    for index in range(0, len(subject_identifiers), subject_batch_size):
+        queryset = model.objects.filter(
+            subject_identifier__in=subject_identifiers[index:index + subject_batch_size]).order_by('pk')
+        total += update_queryset(queryset, chunk_size)
+    return total
+
+
+def update_queryset(queryset, chunk_size=500):
+    """Runs all rule groups for the visits in the queryset, ordered by pk,
+    in chunks of `chunk_size` visits. Returns the number of visits updated."""
+    total = 0
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        visits = list(chunk[:chunk_size])
+        if not visits:
+            break
+        with transaction.atomic():
+            site_rule_groups.update_many(visits)
+        last_pk = visits[-1].pk
+        total += len(visits)
+    return total
+
+
+def _update_shard(args):
+    return update_shard(*args)
+
+
+def update_parallel(visit_model, workers, chunk_size=500):
+    """Runs all rule groups for every visit of `visit_model` sharded by
+    subject across a pool of `workers` processes.
+
+    Returns a tuple of (visits updated, seconds elapsed)."""
+    model = django_apps.get_model(*visit_model.split('.'))
+    subject_identifiers = set(model.objects.values_list('subject_identifier', flat=True))
+    shards = [shard for shard in get_shards(subject_identifiers, workers) if shard]
+    started = time.time()
+    if workers == 1:
+        total = sum(update_shard(visit_model, shard, chunk_size) for shard in shards)
+    else:
+        connections.close_all()
+        with multiprocessing.Pool(processes=workers, initializer=init_worker) as pool:
+            total = sum(pool.map(_update_shard, [(visit_model, shard, chunk_size) for shard in shards]))
+    return total, time.time() - started
@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+
+class PendingVisits:
+
+    """Visits marked as needing their rules run and, for each, the source
+    models whose rules should run.
+
+    A source model of None means all rules for the visit. Marking a visit
+    more than once coalesces into a single entry.
+    """
+
+    def __init__(self):
+        self.visits = OrderedDict()
+
+    def __repr__(self):
+        return '<{}({} visits)>'.format(self.__class__.__name__, len(self.visits))
+
+    def __len__(self):
+        return len(self.visits)
+
+    def add(self, visit_instance, source_model=None):
+        """Marks the visit as pending for the source model."""
+        key = (visit_instance._meta.label_lower, visit_instance.pk)
+        try:
+            _, source_models = self.visits[key]
+        except KeyError:
+            source_models = []
+        if source_model is None:
+            source_models = [None]
+        elif None not in source_models and source_model not in source_models:
+            source_models.append(source_model)
+        self.visits[key] = (visit_instance, source_models)
+
+    def update(self, other):
+        """Adds the pending visits of other."""
+        for visit_instance, source_models in other.visits.values():
+            for source_model in source_models:
+                self.add(visit_instance, source_model)
+
+    def refresh(self):
+        """Replaces each visit instance with a fresh copy from the database,
+        dropping visits that no longer exist."""
+        pks = OrderedDict()
+        for visit_instance, _ in self.visits.values():
+            pks.setdefault(type(visit_instance), []).append(visit_instance.pk)
+        fresh = {}
+        for model, model_pks in pks.items():
+            for pk, visit_instance in model.objects.in_bulk(model_pks).items():
+                fresh[(visit_instance._meta.label_lower, pk)] = visit_instance
+        self.visits = OrderedDict(
+            (key, (fresh[key], source_models))
+            for key, (_, source_models) in self.visits.items() if key in fresh)
+
+    def pop_all(self):
+        """Returns a list of (visit_instance, source_models) and clears."""
+        visits = list(self.visits.values())
+        self.visits = OrderedDict()
+        return visits
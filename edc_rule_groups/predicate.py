@@ -1,30 +1,144 @@
+import hashlib
+
+from django.db.models import Q
+
+from .predicate_stats import predicate_stats
+
+
+ATTR = 'attr'
+MISSING = 'missing'
+SKIP = 'skip'
+
 
 class PredicateError(Exception):
     pass
 
 
+def get_predicate_key(predicate):
+    """Returns a hashable key equal for structurally equal predicates.
+
+    Predicates without a `key`, or with an unhashable key, are their
+    own key."""
+    try:
+        key = predicate.key
+        hash(key)
+    except (AttributeError, TypeError):
+        return predicate
+    return key
+
+
+def get_stats_key(predicate):
+    """Returns a string identifying the predicate in saved statistics or
+    None if it cannot be identified the same way in every process.
+
+    A function is identified by its module, qualified name, first line
+    and a digest of its code, so lambdas declared in the same scope get
+    different keys. A function with a closure is not identified since
+    it depends on the values closed over."""
+    try:
+        return predicate.stats_key
+    except AttributeError:
+        pass
+    code = getattr(predicate, '__code__', None)
+    if code is None:
+        return '{}.{}'.format(
+            getattr(predicate, '__module__', None), getattr(predicate, '__qualname__', repr(predicate)))
+    if getattr(predicate, '__closure__', None):
+        return None
+    consts = tuple(const.co_code if hasattr(const, 'co_code') else const for const in code.co_consts)
+    digest = hashlib.sha1(code.co_code + repr((consts, code.co_names)).encode()).hexdigest()[:12]
+    return '{}.{}:{}:{}'.format(predicate.__module__, predicate.__qualname__, code.co_firstlineno, digest)
+
+
 class Base:
 
+    __slots__ = ()
+
+    # {(attr, arg types): [resolution of each arg]}, see get_resolution
+    resolution_plans = {}
+
     def get_value(self, *args, attr=None):
         """Returns a value by checking for the attr on each arg.
 
-        Each arg in args may be a model instance, queryset, or None."""
+        Each arg in args may be a model instance, queryset, lazy source
+        queryset, or None.
+
+        How each arg resolves the attr is learned per attr and arg types
+        and kept in `resolution_plans` so later calls read the attr
+        directly or skip args that cannot supply it. The first truthy
+        value found is returned, as without a plan."""
+        plan = self.get_resolution_plan(attr, args)
         value = None
-        for arg in args:
+        for index, arg in enumerate(args):
+            if self.is_skipped(plan[index], arg, attr):
+                continue
             try:
                 value = getattr(arg, attr)
+            except AttributeError:
+                plan[index] = self.get_resolution(arg, attr)
+                value = self.get_iterated_value(arg, attr, value)
+            else:
+                plan[index] = ATTR
                 if value:
                     break
-            except AttributeError:
-                try:
-                    for obj in arg:
-                        value = getattr(obj, attr)
-                        if value:
-                            break
-                except (AttributeError, TypeError):
-                    pass
         return value
 
+    def get_resolution_plan(self, attr, args):
+        """Returns the list of the resolution of each arg for the attr and
+        arg types, adding an unresolved plan if there is none."""
+        key = (attr, tuple(type(arg) for arg in args))
+        try:
+            return self.resolution_plans[key]
+        except KeyError:
+            return self.resolution_plans.setdefault(key, [None] * len(args))
+
+    @staticmethod
+    def is_skipped(resolution, arg, attr):
+        """Returns True if the plan says arg cannot supply the attr."""
+        if resolution is SKIP:
+            return True
+        return resolution is MISSING and attr not in arg.__dict__
+
+    @staticmethod
+    def get_resolution(arg, attr):
+        """Returns how to resolve the attr on args of the type of arg after
+        reading the attr raised AttributeError.
+
+        SKIP for None. MISSING for plain instances that are not iterable
+        and whose class does not define the attr, which then only need
+        the attr looked up in their __dict__. None if the attr must be
+        looked up and iterated for as usual."""
+        if arg is None:
+            return SKIP
+        cls = type(arg)
+        if cls.__getattribute__ is not object.__getattribute__ or hasattr(cls, attr):
+            return None
+        if any(hasattr(cls, name) for name in ('__getattr__', '__iter__', '__getitem__', 'iter_values')):
+            return None
+        if not isinstance(getattr(arg, '__dict__', None), dict):
+            return None
+        return MISSING
+
+    def get_iterated_value(self, arg, attr, value=None):
+        """Returns the first truthy attr of the objects in arg, else the
+        last one read, else `value`."""
+        try:
+            for value in self.iter_values(arg, attr):
+                if value:
+                    break
+        except (AttributeError, TypeError):
+            pass
+        return value
+
+    def iter_values(self, arg, attr):
+        """Returns an iterator of attr for each object in arg.
+
+        A lazy source queryset streams only the values needed."""
+        try:
+            return arg.iter_values(attr)
+        except AttributeError:
+            return (getattr(obj, attr) for obj in arg)
+
 
 class P(Base):
 
@@ -56,6 +170,26 @@ class P(Base):
         '!=': lambda x, y: True if x != y else False,
     }
 
+    lookups = {
+        'gt': 'gt',
+        '>': 'gt',
+        'gte': 'gte',
+        '>=': 'gte',
+        'lt': 'lt',
+        '<': 'lt',
+        'lte': 'lte',
+        '<=': 'lte',
+        'eq': 'exact',
+        'equals': 'exact',
+        '==': 'exact',
+        'neq': 'exact',
+        '!=': 'exact',
+    }
+
+    negated_operators = ['is not', 'neq', '!=']
+
+    __slots__ = ('attr', 'operator', 'expected_value', 'func')
+
     def __init__(self, attr, operator, expected_value):
         self.attr = attr
         self.operator = operator
@@ -66,10 +200,52 @@ class P(Base):
         return '<{}({}, {}, {})>'.format(
             self.__class__.__name__, self.attr, self.operator, self.expected_value)
 
+    @property
+    def stats_key(self):
+        return repr(self)
+
+    @property
+    def attrs(self):
+        """Returns a tuple of the attrs the predicate reads."""
+        return (self.attr, )
+
+    @property
+    def key(self):
+        """Returns a tuple that is equal for structurally equal predicates."""
+        return (self.__class__, self.attr, self.operator, type(self.expected_value), self.expected_value)
+
     def __call__(self, *args):
         value = self.get_value(*args, attr=self.attr)
         return self.func(value, self.expected_value)
 
+    def as_q(self, prefix=None):
+        """Returns a Q object equivalent to the predicate.
+
+        `prefix` is the lookup path from the queried model to the model
+        with the attr, e.g. 'subjectvisit__crfone'.
+
+        For example:
+
+            P('gender', 'eq', MALE).as_q()  # Q(gender__exact=MALE)
+            P('referral_datetime', 'is not', None).as_q()  # Q(referral_datetime__isnull=False)
+        """
+        field = '{}__{}'.format(prefix, self.attr) if prefix else self.attr
+        if self.operator in ['is', 'is not']:
+            if self.expected_value is None:
+                return Q(**{'{}__isnull'.format(field): self.operator == 'is'})
+            if not isinstance(self.expected_value, bool):
+                raise PredicateError(
+                    'Operator \'{}\' can only be compiled for None, True or False. Got {}'.format(
+                        self.operator, self))
+            lookup = 'exact'
+        else:
+            try:
+                lookup = self.lookups[self.operator]
+            except KeyError:
+                raise PredicateError('Unknown operator. Got {}'.format(self))
+        q = Q(**{'{}__{}'.format(field, lookup): self.expected_value})
+        return ~q if self.operator in self.negated_operators else q
+
 
 class PF(Base):
     """
@@ -92,6 +268,9 @@ class PF(Base):
                     ...
 
     """
+
+    __slots__ = ('attrs', 'func')
+
     def __init__(self, *attrs, func=None):
         self.attrs = attrs
         self.func = func
@@ -102,5 +281,187 @@ class PF(Base):
             values.append(self.get_value(*args, attr=attr))
         return self.func(*values)
 
+    @property
+    def key(self):
+        """Returns a tuple that is equal for predicates with the same attrs and func."""
+        return (self.__class__, self.attrs, self.func)
+
     def __repr__(self):
-        return '<{}({}, {})>'.format(self.__class__.__name__, self.attr, self.func)
+        return '<{}({}, {})>'.format(self.__class__.__name__, self.attrs, self.func)
+
+    @property
+    def stats_key(self):
+        func_key = get_stats_key(self.func)
+        if func_key is None:
+            return None
+        return '<{}({}, {})>'.format(self.__class__.__name__, self.attrs, func_key)
+
+    def as_q(self, prefix=None):
+        raise PredicateError('Predicates with a function cannot be compiled to a Q object. Got {}'.format(self))
+
+
+class Composite(Base):
+
+    """Base class for predicates that combine other predicates.
+
+    Sub-predicates are evaluated in the order declared, or in the order
+    given by the statistics loaded into `predicate_stats`, and the
+    evaluation stops at the first sub-predicate that decides the result.
+
+    Set `reorder=False` to always evaluate in the order declared, e.g.
+    where a sub-predicate guards against a value a later one cannot
+    handle:
+
+        predicate = And(P('age', 'is not', None), P('age', '>=', 18), reorder=False)
+    """
+
+    __slots__ = ('predicates', 'reorder', '_order', '_order_version')
+
+    stop_value = None
+
+    def __init__(self, *predicates, reorder=True):
+        for predicate in predicates:
+            if not hasattr(predicate, '__call__'):
+                raise PredicateError('Expected a predicate. Got {}'.format(predicate))
+        self.predicates = predicates
+        self.reorder = reorder
+        self._order = None
+        self._order_version = None
+
+    def __repr__(self):
+        return '<{}({})>'.format(self.__class__.__name__, ', '.join(repr(p) for p in self.predicates))
+
+    def __call__(self, *args):
+        for predicate, key in self.ordered:
+            if bool(predicate_stats.call(key, predicate, *args)) == self.stop_value:
+                return self.stop_value
+        return not self.stop_value
+
+    @property
+    def ordered(self):
+        """Returns a list of (predicate, stats key) in the order to evaluate them."""
+        if self._order is None or self._order_version != predicate_stats.version:
+            keys = [get_stats_key(predicate) for predicate in self.predicates]
+            order = predicate_stats.get_order(keys, self.stop_value) if self.reorder else range(len(keys))
+            self._order = [(self.predicates[index], keys[index]) for index in order]
+            self._order_version = predicate_stats.version
+        return self._order
+
+    @property
+    def attrs(self):
+        """Returns a tuple of the attrs read by the sub-predicates or None if not known."""
+        attrs = []
+        for predicate in self.predicates:
+            predicate_attrs = getattr(predicate, 'attrs', None)
+            if predicate_attrs is None:
+                return None
+            attrs.extend(attr for attr in predicate_attrs if attr not in attrs)
+        return tuple(attrs)
+
+    @property
+    def key(self):
+        return (self.__class__, tuple(get_predicate_key(predicate) for predicate in self.predicates),
+                self.reorder)
+
+    @property
+    def stats_key(self):
+        keys = [get_stats_key(predicate) for predicate in self.predicates]
+        if None in keys:
+            return None
+        return '<{}({})>'.format(self.__class__.__name__, ', '.join(keys))
+
+    def get_qs(self, prefix=None):
+        qs = []
+        for predicate in self.predicates:
+            try:
+                as_q = predicate.as_q
+            except AttributeError:
+                raise PredicateError('Predicate cannot be compiled to a Q object. Got {}'.format(predicate))
+            qs.append(as_q(prefix=prefix))
+        return qs
+
+
+class And(Composite):
+
+    """True if all predicates are true.
+
+    For example:
+
+        predicate = And(P('gender', 'eq', MALE), P('age', '>=', 18))
+    """
+
+    __slots__ = ()
+
+    stop_value = False
+
+    def as_q(self, prefix=None):
+        q = Q()
+        for sub_q in self.get_qs(prefix=prefix):
+            q &= sub_q
+        return q
+
+
+class Or(Composite):
+
+    """True if any predicate is true.
+
+    For example:
+
+        predicate = Or(P('f1', 'eq', 'car'), P('f1', 'eq', 'bicycle'))
+    """
+
+    __slots__ = ()
+
+    stop_value = True
+
+    def as_q(self, prefix=None):
+        qs = self.get_qs(prefix=prefix)
+        q = qs[0] if qs else Q()
+        for sub_q in qs[1:]:
+            q |= sub_q
+        return q
+
+
+class Not(Base):
+
+    """True if the predicate is false.
+
+    For example:
+
+        predicate = Not(P('f1', 'eq', 'car'))
+    """
+
+    __slots__ = ('predicate', )
+
+    def __init__(self, predicate):
+        if not hasattr(predicate, '__call__'):
+            raise PredicateError('Expected a predicate. Got {}'.format(predicate))
+        self.predicate = predicate
+
+    def __repr__(self):
+        return '<{}({!r})>'.format(self.__class__.__name__, self.predicate)
+
+    def __call__(self, *args):
+        return not self.predicate(*args)
+
+    @property
+    def attrs(self):
+        return getattr(self.predicate, 'attrs', None)
+
+    @property
+    def key(self):
+        return (self.__class__, get_predicate_key(self.predicate))
+
+    @property
+    def stats_key(self):
+        key = get_stats_key(self.predicate)
+        if key is None:
+            return None
+        return '<{}({})>'.format(self.__class__.__name__, key)
+
+    def as_q(self, prefix=None):
+        try:
+            as_q = self.predicate.as_q
+        except AttributeError:
+            raise PredicateError('Predicate cannot be compiled to a Q object. Got {}'.format(self.predicate))
+        return ~as_q(prefix=prefix)
@@ -0,0 +1,160 @@
+import threading
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.apps import apps as django_apps
+from django.db import connection, transaction
+
+from .pending_visits import PendingVisits
+from .site_rule_groups import site_rule_groups
+
+
+class RuleQueue(ABC):
+
+    """Base class for a queue of requests to run the rules for a visit.
+
+    Set `site_rule_groups.queue` to an instance to run rules
+    asynchronously instead of in the save path. Requests for a visit
+    that is already pending are merged into the pending request.
+    """
+
+    def __init__(self, site=None):
+        self.site = site or site_rule_groups
+
+    @abstractmethod
+    def enqueue(self, visit_instance, source_model=None):
+        """Queues running the rules for the visit (and source model key)."""
+
+    @abstractmethod
+    def join(self):
+        """Blocks until the queue is drained."""
+
+    def run(self, visit_model, visit_pk, source_models):
+        """Runs the rules for a queued visit, fetched fresh from the database."""
+        model = django_apps.get_model(*visit_model.split('.'))
+        try:
+            visit_instance = model.objects.get(pk=visit_pk)
+        except model.DoesNotExist:
+            return
+        pending = PendingVisits()
+        for source_model in source_models:
+            pending.add(visit_instance, source_model)
+        self.site.update_pending(pending)
+
+
+class ThreadPoolQueue(RuleQueue):
+
+    """Runs queued visits in a pool of threads in this process.
+
+    Visits are queued once the current transaction commits so the
+    worker threads, which use their own database connections, see
+    the saved data.
+    """
+
+    def __init__(self, max_workers=2, **kwargs):
+        super().__init__(**kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = PendingVisits()
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def enqueue(self, visit_instance, source_model=None):
+        transaction.on_commit(lambda: self._enqueue(visit_instance, source_model))
+
+    def _enqueue(self, visit_instance, source_model):
+        key = (visit_instance._meta.label_lower, visit_instance.pk)
+        with self.lock:
+            submit = key not in self.pending.visits
+            self.pending.add(visit_instance, source_model)
+            if submit:
+                self.futures.append(self.executor.submit(self._run, key))
+
+    def _run(self, key):
+        with self.lock:
+            _, source_models = self.pending.visits.pop(key)
+        try:
+            self.run(key[0], key[1], source_models)
+        finally:
+            connection.close()
+
+    def join(self):
+        """Blocks until all queued visits have run and re-raises the first
+        exception raised by a worker, if any."""
+        while True:
+            with self.lock:
+                futures, self.futures = self.futures, []
+            if not futures:
+                break
+            wait(futures)
+            for future in futures:
+                future.result()
+
+
+class DatabaseQueue(RuleQueue):
+
+    """Queues visits in the RuleJob table in the same transaction as the
+    save. Run `process` from a worker, e.g. the process_rule_jobs
+    management command.
+
+    A job whose rules raise keeps its row with the exception in `error`
+    and is not run again until the visit is queued again. Workers skip
+    jobs locked by another worker where the database supports it.
+    """
+
+    job_model = 'edc_rule_groups.rulejob'
+
+    @property
+    def model(self):
+        return django_apps.get_model(*self.job_model.split('.'))
+
+    def enqueue(self, visit_instance, source_model=None):
+        source_model = '.'.join(source_model) if source_model else None
+        job, created = self.model.objects.get_or_create(
+            visit_model=visit_instance._meta.label_lower,
+            visit_pk=str(visit_instance.pk),
+            defaults={'source_models': source_model})
+        if not created:
+            if job.source_models is not None:
+                source_models = job.source_models.split(',')
+                if source_model is None:
+                    job.source_models = None
+                elif source_model not in source_models:
+                    job.source_models = ','.join(source_models + [source_model])
+            job.error = None
+            job.save(update_fields=['source_models', 'error'])
+
+    def get_next_job(self):
+        """Returns the first queued job not failed or locked by another
+        worker, locking it until the transaction ends, or None."""
+        queryset = self.model.objects.filter(error__isnull=True).order_by('id')
+        if getattr(connection.features, 'has_select_for_update_skip_locked', False):
+            return queryset.select_for_update(skip_locked=True).first()
+        return queryset.select_for_update().first()
+
+    def process(self, limit=None):
+        """Runs queued visits in the order queued. Returns the number of
+        jobs processed, failed jobs included."""
+        count = 0
+        while limit is None or count < limit:
+            with transaction.atomic():
+                job = self.get_next_job()
+                if job is None:
+                    break
+                source_models = (
+                    [None] if job.source_models is None
+                    else [tuple(label.split('.')) for label in job.source_models.split(',')])
+                try:
+                    with transaction.atomic():
+                        self.run(job.visit_model, job.visit_pk, source_models)
+                except Exception as e:
+                    job.error = '{}: {}'.format(e.__class__.__name__, str(e))
+                    job.save(update_fields=['error'])
+                else:
+                    job.delete()
+            count += 1
+        return count
+
+    def join(self):
+        """Processes the queue in this thread until it is empty."""
+        self.process()
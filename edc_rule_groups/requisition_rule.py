@@ -1,31 +1,33 @@
-from django.core.exceptions import ObjectDoesNotExist
-
-from .exceptions import RequisitionRuleGroupErrror
 from .rule import Rule
+from .visit_context import visit_context
 
 
 class RequisitionRule(Rule):
 
+    __slots__ = ('target_model', 'target_panels')
+
     def __init__(self, target_model, target_panels, **kwargs):
         self.rule_type = 'requisition'
         self.target_model = target_model
         self.target_panels = target_panels
         super(RequisitionRule, self).__init__(**kwargs)
 
-    def run_rules(self, target_model, visit, *args):
-        for panel in self.target_panels:
-            try:
-                panel_name = panel.name
-            except AttributeError as e:
-                raise RequisitionRuleGroupErrror('{} Expected panel instance. Got panel={}.'.format(str(e), panel))
-            try:
-                target_model.objects.get_for_visit(visit, panel_name=panel_name)
-            except target_model.DoesNotExist:
-                entry_status = self.evaluate(visit, *args)
-                try:
-                    visit.metadata_update_for_model(
-                        target_model._meta.label_lower,
-                        entry_status=entry_status,
-                        panel_name=panel_name)
-                except ObjectDoesNotExist:
-                    pass
+    def run(self, visit, context=None):
+        """Runs the rule as Rule.run does and, if no context is passed,
+        writes the updates for all panels in one bulk update."""
+        with visit_context(visit, context, batch=True) as context:
+            super().run(visit, context=context)
+
+    def run_rules(self, target_model, visit, *args, context=None):
+        """Evaluates the rule once for the visit and updates the metadata of
+        each target panel not yet keyed.
+
+        The keyed panels are read from the visit's metadata in one query
+        and, if no context is passed, the updates for all panels are
+        written in one bulk update."""
+        model = target_model._meta.label_lower
+        with visit_context(visit, context, batch=True) as context:
+            for panel_name in self.plan.panel_names:
+                if not context.is_keyed(model, panel_name=panel_name):
+                    entry_status = context.evaluate(self, *args)
+                    context.update_metadata(model, entry_status=entry_status, panel_name=panel_name)
@@ -1,12 +1,18 @@
-from django.apps import apps as django_apps
+from edc_metadata.constants import KEYED
 
 from .constants import DO_NOTHING
-from django.core.exceptions import ObjectDoesNotExist, FieldError
 from edc_rule_groups.exceptions import RuleError
 
+from .predicate import PredicateError
+from .rule_plan import RulePlan
+from .visit_context import visit_context
+
 
 class Rule:
 
+    __slots__ = ('source_model', 'name', 'group', 'app_label', 'logic', 'rule_type', 'target_models',
+                 'decision_table', '_plan')
+
     def __init__(self, logic):
 
         self.source_model = None  # set by metaclass
@@ -16,64 +22,87 @@ class Rule:
         self.group = None  # set by metaclass
         self.app_label = None  # set by metaclass
         self.logic = logic
+        self.decision_table = None  # set by metaclass
+        self._plan = None
 
     def __repr__(self):
         return '<{}.rule_groups.{}: {}>'.format(self.app_label, self.group, self.name)
 
-    def run(self, visit):
+    def run(self, visit, context=None):
         """ Runs the rule for each model in target_models and updates metadata if the model
-        instance does not exist."""
-        try:
-            app_config = django_apps.get_app_config('edc_registration')
-            registered_subject = app_config.model.objects.get(subject_identifier=visit.subject_identifier)
-        except app_config.model.DoesNotExist:
-            registered_subject = None
+        instance does not exist.
+
+        Pass a VisitContext to share the registered subject and source objects
+        with the other rules run for this visit."""
+        if not self.runif(visit):
+            return
+        with visit_context(visit, context) as context:
+            args = self.get_predicate_args(context)
+            if args is None:
+                return  # without source_obj, predicate will fail
+            for target_model in self.plan.target_models:
+                self.run_rules(target_model, visit, *args, context=context)
+
+    def get_predicate_args(self, context):
+        """Returns a tuple of (registered_subject, source_obj, source_qs) for
+        the context's visit or None if the source model instance does not exist."""
+        plan = self.plan
         source_obj = None
         source_qs = None
-        if self.source_model:
-            source_model = django_apps.get_model(*self.source_model)
-            try:
-                source_obj = source_model.objects.get_for_visit(visit)
-            except source_model.DoesNotExist:
-                source_obj = None
-            except AttributeError as e:
-                if 'get_for_visit' not in str(e):
-                    raise RuleError('{} See \'{}\'.'.format(str(e), source_model._meta.label_lower))
-                source_obj = visit
-            try:
-                source_qs = source_model.objects.filter(subject_identifier=visit.subject_identifier)
-            except FieldError:
-                source_qs = source_model.objects.get_for_subject_identifier(visit.subject_identifier)
-        for target_model in self.target_models:
-            target_model = django_apps.get_model(*target_model.split('.'))
-            print("test runif condition..", self.runif(visit))
-            if self.runif(visit):
-                if self.source_model and not source_obj:
-                    pass  # without source_obj, predicate will fail
-                else:
-                    self.run_rules(target_model, visit, registered_subject, source_obj, source_qs)
-
-    def run_rules(self, target_model, visit, *args):
+        if plan.source_model:
+            source_obj = context.get_source_obj(plan.source_key, plan=plan)
+            if not source_obj:
+                return None
+            source_qs = context.get_source_qs(plan.source_key, plan=plan)
+        return (context.registered_subject, source_obj, source_qs)
+
+    def get_entry_statuses(self, visit, context=None):
+        """Returns a dictionary of {(target model, panel_name): entry_status}
+        decided by the rule for the visit without updating metadata.
+
+        Targets that are keyed are KEYED. Returns an empty dictionary if the
+        rule does not run for the visit and leaves out targets if the
+        rule does nothing."""
+        entry_statuses = {}
+        if not self.runif(visit):
+            return entry_statuses
+        with visit_context(visit, context) as context:
+            args = self.get_predicate_args(context)
+            if args is None:
+                return entry_statuses
+            for target_model in self.plan.target_models:
+                model = target_model._meta.label_lower
+                for panel_name in self.plan.panel_names or (None, ):
+                    if context.is_keyed(model, panel_name=panel_name):
+                        entry_statuses[(model, panel_name)] = KEYED
+                    else:
+                        entry_status = context.evaluate(self, *args)
+                        if entry_status is not None:
+                            entry_statuses[(model, panel_name)] = entry_status
+        return entry_statuses
+
+    @property
+    def plan(self):
+        """Returns the compiled RulePlan, compiling it if needed."""
+        if self._plan is None:
+            self._plan = RulePlan.compile(self)
+        return self._plan
+
+    def compile(self):
+        """Compiles the RulePlan of the rule or raises RuleError.
+
+        Called when the rule group is registered."""
+        self._plan = RulePlan.compile(self)
+        return self._plan
+
+    def run_rules(self, target_model, visit, *args, context=None):
         if target_model._meta.label_lower == visit._meta.label_lower:
             raise RuleError('Target model and visit model are the same. Got {}=={}'.format(
                 target_model._meta.label_lower, visit._meta.label_lower))
-        try:
-            target_model.objects.get_for_visit(visit)
-        except target_model.DoesNotExist:
-            entry_status = self.evaluate(visit, *args)
-            try:
-                visit.metadata_update_for_model(
-                    target_model._meta.label_lower,
-                    entry_status=entry_status)
-            except ObjectDoesNotExist:
-                pass
-        except AttributeError as e:
-            if 'get_for_visit' in str(e):
-                raise RuleError('An exception was raised for target model \'{}\'. Got {}'.format(
-                    target_model._meta.label_lower,
-                    str(e)))
-            else:
-                raise RuleError(str(e))
+        with visit_context(visit, context) as context:
+            if not context.is_keyed(target_model._meta.label_lower):
+                entry_status = context.evaluate(self, *args)
+                context.update_metadata(target_model._meta.label_lower, entry_status=entry_status)
 
     def runif(self, visit, **kwargs):
         """May be overridden to run only on a condition."""
@@ -81,14 +110,52 @@ class Rule:
 
     def evaluate(self, visit, *args):
         """ Evaluates the predicate function and returns a result."""
+        return self.get_result(self.evaluate_predicate(visit, *args))
+
+    def evaluate_predicate(self, visit, *args):
+        """Returns True if the predicate is true for the visit."""
         try:
-            if self.logic.predicate(visit, *args):
-                result = self.logic.consequence if self.logic.consequence != DO_NOTHING else None
-            else:
-                result = self.logic.alternative if self.logic.alternative != DO_NOTHING else None
+            return bool(self.logic.predicate(visit, *args))
         except Exception as e:
             raise RuleError('An exception was raised when running rule {}. Got {}'.format(self, str(e)))
-        return result
+
+    def get_result(self, value):
+        """Returns the consequence or alternative for the value of the
+        predicate, None for DO_NOTHING."""
+        if value:
+            return self.logic.consequence if self.logic.consequence != DO_NOTHING else None
+        return self.logic.alternative if self.logic.alternative != DO_NOTHING else None
+
+    def is_triggered_by(self, changed_fields, source_model=None):
+        """Returns False if the rule does not need to run because none of the
+        source model fields it reads are in `changed_fields`.
+
+        A rule that reads an attr that is not a field of the source model
+        or whose attrs are not known is always triggered."""
+        attrs = self.logic.attrs
+        if changed_fields is None or attrs is None or not self.source_model:
+            return True
+        if source_model is None:
+            field_names = self.plan.source_field_names
+        else:
+            field_names = [field.name for field in source_model._meta.concrete_fields]
+        for attr in attrs:
+            if attr not in field_names or attr in changed_fields:
+                return True
+        return False
+
+    def filter_queryset(self, queryset, prefix=None):
+        """Returns the queryset filtered in the database to the rows for
+        which the predicate is True.
+
+        Use to evaluate the rule for a whole cohort in one query; rows
+        not returned get the alternative. See P.as_q for `prefix`."""
+        try:
+            as_q = self.logic.predicate.as_q
+        except AttributeError:
+            raise PredicateError(
+                'Predicate cannot be compiled to a Q object. Got {}'.format(self.logic.predicate))
+        return queryset.filter(as_q(prefix=prefix))
 
     @property
     def __doc__(self):
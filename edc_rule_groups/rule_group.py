@@ -1,8 +1,10 @@
 import inspect
 import copy
 
+from .decision_table import DecisionTable
 from .exceptions import RuleGroupError
 from .rule import Rule
+from .visit_context import visit_context
 
 
 class BaseMeta:
@@ -12,6 +14,7 @@ class BaseMeta:
     source_model = None
     source_fk = None
     rules = None
+    decision_tables = None
 
     def __init__(self, group_name, **meta_attrs):
         for k, v in meta_attrs.items():
@@ -38,9 +41,9 @@ class RuleGroupMeta(type):
         for parent in parents:
             try:
                 if parent.Meta.abstract:
-                    for rule in [member for member in inspect.getmembers(parent) if isinstance(member[1], Rule)]:
-                        parent_rule = copy.deepcopy(rule)
-                        attrs.update({parent_rule[0]: parent_rule[1]})
+                    for rule_name, rule in inspect.getmembers(parent, lambda member: isinstance(member, Rule)):
+                        # a shallow copy; the logic is shared with the parent rule
+                        attrs.update({rule_name: copy.copy(rule)})
             except AttributeError:
                 pass
 
@@ -90,9 +93,11 @@ class RuleGroupMeta(type):
                             rule.target_models = [rule.target_model]
                         rule.source_model = source_model
                         rules.append(rule)
+        # rules testing the same attr for equality are decided by one lookup
+        decision_tables = DecisionTable.attach(rules)
         # add a django like _meta to Rulegroup as an instance of BaseMeta
         meta_attrs = {k: getattr(meta, k) for k in meta.__dict__ if not k.startswith('_')}
-        meta_attrs.update({'rules': tuple(rules)})
+        meta_attrs.update({'rules': tuple(rules), 'decision_tables': tuple(decision_tables)})
         attrs.update({'_meta': BaseMeta(name, **meta_attrs)})
         attrs.update({'name': '{}.{}'.format(meta.app_label, name.lower())})
         return super(RuleGroupMeta, cls).__new__(cls, name, bases, attrs)
@@ -102,22 +107,24 @@ class RuleGroup(object, metaclass=RuleGroupMeta):
     """A class used to decalre and contain rules."""
 
     @classmethod
-    def run_for_source_model(cls, obj, source_model):
-        for rule in cls._meta.rules:
-            if rule.source_model == source_model:
+    def run_for_source_model(cls, obj, source_model, context=None):
+        with visit_context(obj, context) as context:
+            for rule in cls._meta.rules:
+                if rule.source_model == source_model:
+                    try:
+                        rule.run(obj, context=context)
+                    except AttributeError as e:
+                        raise RuleGroupError(
+                            'An exception was raised for rule {} with object \'{}\'. Got {}'.format(
+                                rule, obj._meta.label_lower, str(e)))
+
+    @classmethod
+    def run_all(cls, obj, context=None):
+        with visit_context(obj, context, batch=True) as context:
+            for rule in cls._meta.rules:
                 try:
-                    rule.run(obj)
+                    rule.run(obj, context=context)
                 except AttributeError as e:
                     raise RuleGroupError(
                         'An exception was raised for rule {} with object \'{}\'. Got {}'.format(
                             rule, obj._meta.label_lower, str(e)))
-
-    @classmethod
-    def run_all(cls, obj):
-        for rule in cls._meta.rules:
-            try:
-                rule.run(obj)
-            except AttributeError as e:
-                raise RuleGroupError(
-                    'An exception was raised for rule {} with object \'{}\'. Got {}'.format(
-                        rule, obj._meta.label_lower, str(e)))
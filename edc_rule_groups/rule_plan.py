@@ -0,0 +1,59 @@
+from collections import namedtuple
+
+from django.apps import apps as django_apps
+
+from .exceptions import RequisitionRuleGroupErrror, RuleError
+from .predicate import get_predicate_key
+
+
+class RulePlan(namedtuple('RulePlan', [
+        'source_key', 'source_model', 'source_for_visit', 'source_field_names', 'target_models',
+        'panel_names', 'predicate_key'])):
+
+    """An immutable execution plan for a rule compiled once the models
+    are loaded.
+
+    Holds the resolved source and target model classes and whether the
+    source model manager can get an instance for a visit and, for a
+    requisition rule, the names of the target panels, so running a rule
+    does not look these up again. `predicate_key` is equal for rules with
+    structurally equal predicates. Misconfigured rules raise a RuleError
+    (or RequisitionRuleGroupErrror) when compiled instead of on the
+    first save.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, rule):
+        """Returns a plan for the rule or raises RuleError."""
+        panel_names = ()
+        target_panels = getattr(rule, 'target_panels', None)
+        if target_panels is not None:
+            try:
+                panel_names = tuple(panel.name for panel in target_panels)
+            except AttributeError as e:
+                raise RequisitionRuleGroupErrror(
+                    '{} Expected panel instances on rule {}. Got target_panels={}.'.format(
+                        str(e), rule, target_panels))
+        source_key = source_model = None
+        source_for_visit = False
+        source_field_names = frozenset()
+        if rule.source_model:
+            source_key = tuple(rule.source_model)
+            source_model = cls.get_model(rule, source_key)
+            source_for_visit = hasattr(source_model.objects, 'get_for_visit')
+            source_field_names = frozenset(field.name for field in source_model._meta.concrete_fields)
+        target_models = tuple(
+            cls.get_model(rule, target_model.split('.')) for target_model in rule.target_models)
+        if getattr(rule.logic.predicate, 'func', True) is None:
+            raise RuleError('Invalid predicate on rule {}. Got {}'.format(rule, rule.logic.predicate))
+        return cls(source_key, source_model, source_for_visit, source_field_names, target_models, panel_names,
+                   get_predicate_key(rule.logic.predicate))
+
+    @staticmethod
+    def get_model(rule, model):
+        try:
+            return django_apps.get_model(*model)
+        except (LookupError, ValueError, TypeError) as e:
+            raise RuleError('Invalid model on rule {}. Got {}. {}'.format(rule, '.'.join(model), str(e)))
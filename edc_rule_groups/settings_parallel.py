@@ -0,0 +1,10 @@
+"""Settings to run the tests with a file-backed test database so the
+worker processes of ParallelTests share it, e.g.:
+
+    python manage.py test edc_rule_groups --settings=edc_rule_groups.settings_parallel
+"""
+import os
+
+from .settings import *  # noqa
+
+DATABASES['default']['TEST'] = {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')}  # noqa
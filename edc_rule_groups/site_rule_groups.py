@@ -1,10 +1,23 @@
 import copy
+import heapq
 import sys
+import threading
 
 from collections import OrderedDict
+from contextlib import contextmanager
 from django.apps import apps as django_apps
+from django.db import transaction
 from django.utils.module_loading import import_module, module_has_submodule
 
+from .field_tracker import field_tracker
+from .logic import Logic
+from .metadata_writer import MetadataWriter
+from .pending_visits import PendingVisits
+from .predicate import Base as BasePredicate
+from .rule import Rule
+from .rule_group import RuleGroupMeta
+from .visit_context import VisitContext, visit_context
+
 
 class AlreadyRegistered(Exception):
     pass
@@ -14,22 +27,248 @@ class NotRegistered(Exception):
     pass
 
 
+def model_key(model):
+    """Returns a hashable (app_label, model_name) tuple for a model
+    reference or None.
+
+    Accepts a model class, a model instance, a 'app_label.model_name'
+    string or an (app_label, model_name) list or tuple."""
+    if model is None:
+        return None
+    try:
+        return (model._meta.app_label, model._meta.model_name)
+    except AttributeError:
+        pass
+    try:
+        app_label, model_name = model.split('.')
+    except AttributeError:
+        app_label, model_name = model
+    return (app_label, model_name.lower())
+
+
 class SiteRuleGroups(object):
 
-    """ Main controller of :class:`RuleGroup` objects. """
+    """ Main controller of :class:`RuleGroup` objects.
+
+    If `defer_to_commit` is True, update_all and update_rules_for_source_model
+    called inside a transaction only mark the visit as pending. The rules for
+    each pending visit then run once, in one pass, when the transaction
+    commits. Outside a transaction the rules run immediately.
+
+    If `queue` is set to a queues.RuleQueue, the same calls queue the
+    visit for a worker instead.
+
+    If `track_changes` is True when rule groups are registered, changes to
+    the fields of source model instances are tracked so that
+    update_rules_for_source_model can skip rules whose fields did not change.
+    """
 
     def __init__(self):
         self.registry = OrderedDict()
+        self.defer_to_commit = False
+        self.queue = None
+        self.track_changes = False
+        self.predicates = {}
+        self._thread = threading.local()
+        self._reset_indexes()
 
     def register(self, rule_group):
         """ Register Rule groups to the list for the module the rule
-        groups were declared in."""
+        groups were declared in.
+
+        If the models are loaded each rule is compiled to its RulePlan,
+        so a misconfigured rule raises RuleError here, and structurally
+        equal predicates are replaced by the first one registered."""
         if rule_group._meta.app_label not in self.registry:
             self.registry.update({rule_group._meta.app_label: []})
         for rg in self.registry.get(rule_group._meta.app_label):
             if rg.name == rule_group.name:
                 raise AlreadyRegistered('The rule group {0} is already registered'.format(rule_group.name))
+        if django_apps.models_ready:
+            for rule in rule_group._meta.rules:
+                rule.compile()
+                rule.logic.predicate = self.predicates.setdefault(
+                    rule.plan.predicate_key, rule.logic.predicate)
         self.registry.get(rule_group._meta.app_label).append(rule_group)
+        self._index_rule_group(rule_group)
+        if django_apps.models_ready and self.track_changes:
+            for rule in rule_group._meta.rules:
+                if rule.plan.source_model:
+                    field_tracker.track(rule.plan.source_model)
+
+    def _reset_indexes(self):
+        """Clears the rule lookup indexes.
+
+        Each index maps (app_label, key) to a list of rules in
+        registration order. `dependency_graph` maps each source model
+        key to the keys of the target models of its rules."""
+        self.source_model_index = {}
+        self.source_fk_model_index = {}
+        self.visit_code_index = {}
+        self.target_model_index = {}
+        self.dependency_graph = OrderedDict()
+        self._model_order = None
+
+    def _rebuild_indexes(self):
+        """Rebuilds the rule lookup indexes from the registry."""
+        self._reset_indexes()
+        for rule_groups in self.registry.values():
+            for rule_group in rule_groups:
+                self._index_rule_group(rule_group)
+
+    def _index_rule_group(self, rule_group):
+        """Adds the rules of a registered rule group to the lookup indexes."""
+        app_label = rule_group._meta.app_label
+        self._model_order = None
+        for rule in rule_group._meta.rules:
+            source_key = model_key(rule.source_model)
+            if source_key:
+                targets = self.dependency_graph.setdefault(source_key, [])
+                for target_model in rule.target_models:
+                    if model_key(target_model) not in targets:
+                        targets.append(model_key(target_model))
+            self.source_model_index.setdefault(
+                (app_label, model_key(rule.source_model)), []).append(rule)
+            source_fk_model = getattr(rule, 'source_fk_model', None)
+            if source_fk_model:
+                self.source_fk_model_index.setdefault(
+                    (app_label, model_key(source_fk_model)), []).append(rule)
+            for target_model in rule.target_models:
+                self.target_model_index.setdefault(
+                    (app_label, model_key(target_model)), []).append(rule)
+            self._index_visit_codes(app_label, rule)
+
+    def _index_visit_codes(self, app_label, rule):
+        """Adds a rule to the visit code index.
+
+        Rules without visit codes apply to any visit and are kept under
+        visit code None as well as under every known visit code so that
+        each list stays in registration order."""
+        visit_codes = getattr(rule, 'visit_codes', None)
+        if not visit_codes:
+            for (label, _), rules in self.visit_code_index.items():
+                if label == app_label:
+                    rules.append(rule)
+            self.visit_code_index.setdefault((app_label, None), []).append(rule)
+        else:
+            for visit_code in visit_codes:
+                if (app_label, visit_code) not in self.visit_code_index:
+                    self.visit_code_index[(app_label, visit_code)] = list(
+                        self.visit_code_index.get((app_label, None), []))
+                self.visit_code_index[(app_label, visit_code)].append(rule)
+
+    @property
+    def model_order(self):
+        """Returns a dictionary of {model key: position} of the models in
+        the dependency graph in topological order.
+
+        Models on a cycle are placed after the others in the order first
+        seen. See get_cycles."""
+        if self._model_order is None:
+            models = OrderedDict()
+            for source_key, target_keys in self.dependency_graph.items():
+                models[source_key] = None
+                for target_key in target_keys:
+                    models[target_key] = None
+            in_degree = OrderedDict((key, 0) for key in models)
+            for target_keys in self.dependency_graph.values():
+                for target_key in target_keys:
+                    in_degree[target_key] += 1
+            ready = [key for key, degree in in_degree.items() if not degree]
+            order = []
+            while ready:
+                key = ready.pop(0)
+                order.append(key)
+                for target_key in self.dependency_graph.get(key, []):
+                    in_degree[target_key] -= 1
+                    if not in_degree[target_key]:
+                        ready.append(target_key)
+            order.extend(key for key in models if key not in order)
+            self._model_order = {key: index for index, key in enumerate(order)}
+        return self._model_order
+
+    def get_downstream_models(self, models):
+        """Returns a list of the keys of the given models and every model
+        reachable from them in the dependency graph, in topological order.
+
+        Models the dependency graph does not order relative to each other
+        keep the order of `models`, e.g. the entry order of a visit
+        definition, then the order of model_order."""
+        models = [model_key(model) for model in models]
+        reachable = set()
+        keys = list(models)
+        while keys:
+            key = keys.pop()
+            if key not in reachable:
+                reachable.add(key)
+                keys.extend(self.dependency_graph.get(key, []))
+        entry_order = {}
+        for index, key in enumerate(models):
+            entry_order.setdefault(key, index)
+        model_order = self.model_order
+
+        def priority(key):
+            return (entry_order.get(key, len(models)), model_order.get(key, len(model_order)), key)
+
+        return self.sort_models(reachable, priority)
+
+    def sort_models(self, keys, priority):
+        """Returns a list of the model keys in topological order, taking the
+        ready model with the lowest priority first.
+
+        Models on a cycle are placed after the others in order of priority."""
+        in_degree = {key: 0 for key in keys}
+        for key in keys:
+            for target_key in self.dependency_graph.get(key, []):
+                if target_key in in_degree:
+                    in_degree[target_key] += 1
+        ready = [priority(key) for key, degree in in_degree.items() if not degree]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            key = heapq.heappop(ready)[-1]
+            order.append(key)
+            for target_key in self.dependency_graph.get(key, []):
+                if target_key in in_degree:
+                    in_degree[target_key] -= 1
+                    if not in_degree[target_key]:
+                        heapq.heappush(ready, priority(target_key))
+        ordered = set(order)
+        order.extend(sorted((key for key in keys if key not in ordered), key=priority))
+        return order
+
+    def get_cycles(self):
+        """Returns a list of the cycles in the dependency graph, each a
+        list of model keys."""
+        cycles = []
+        index = {}
+        lowlink = {}
+        stack = []
+        for key in list(self.dependency_graph):
+            if key not in index:
+                self._visit_component(key, index, lowlink, stack, cycles)
+        return cycles
+
+    def _visit_component(self, key, index, lowlink, stack, cycles):
+        """Visits a model key for get_cycles (Tarjan's strongly connected
+        components), appending each cycle found to `cycles`."""
+        index[key] = lowlink[key] = len(index)
+        stack.append(key)
+        for target_key in self.dependency_graph.get(key, []):
+            if target_key not in index:
+                self._visit_component(target_key, index, lowlink, stack, cycles)
+                lowlink[key] = min(lowlink[key], lowlink[target_key])
+            elif target_key in stack:
+                lowlink[key] = min(lowlink[key], index[target_key])
+        if lowlink[key] == index[key]:
+            component = []
+            while True:
+                member = stack.pop()
+                component.insert(0, member)
+                if member == key:
+                    break
+            if len(component) > 1 or key in self.dependency_graph.get(key, []):
+                cycles.append(component)
 
     def get(self, app_label):
         return self.registry.get(app_label)
@@ -41,43 +280,266 @@ class SiteRuleGroups(object):
                 return rule_group
         return None
 
+    def defer(self, visit_instance, source_model=None):
+        """Returns True if running the rules for the visit (and source model)
+        was deferred instead of running now."""
+        deferred = getattr(self._thread, 'deferred', None)
+        if deferred is not None:
+            deferred.add(visit_instance, model_key(source_model))
+            return True
+        if self.queue is not None:
+            self.queue.enqueue(visit_instance, model_key(source_model))
+            return True
+        if self.defer_to_commit and transaction.get_connection().in_atomic_block:
+            self.get_pending_on_commit().add(visit_instance, model_key(source_model))
+            return True
+        return False
+
+    def get_pending_on_commit(self):
+        """Returns the pending visits of this thread, registering a callback
+        to run them when the current transaction commits.
+
+        A callback is registered on each call. The first to run updates
+        and clears the pending visits, the others find nothing to do.
+        Visits left pending by a transaction that rolled back are updated
+        when the next transaction commits. The callback re-fetches each
+        visit from the database first, so rules never run on values that
+        were rolled back, and visits that no longer exist are skipped."""
+        pending = getattr(self._thread, 'on_commit', None)
+        if pending is None:
+            pending = PendingVisits()
+            self._thread.on_commit = pending
+        transaction.on_commit(lambda: self.update_pending(pending, refresh=True))
+        return pending
+
+    @contextmanager
+    def deferred(self, chunk_size=500):
+        """Suspends running rules in this thread for the duration of the block.
+
+        Visits that would have had rules run are collected and updated once
+        each when the outermost block exits, whether or not it raised. Visits
+        needing all rules are updated together with update_many in chunks of
+        `chunk_size`.
+
+        For example:
+
+            with site_rule_groups.deferred():
+                for row in rows:
+                    CrfOne.objects.create(**row)
+        """
+        pending = getattr(self._thread, 'deferred', None)
+        if pending is not None:
+            yield pending
+            return
+        pending = PendingVisits()
+        self._thread.deferred = pending
+        try:
+            yield pending
+        finally:
+            self._thread.deferred = None
+            self.update_pending(pending, chunk_size=chunk_size)
+
+    def update_pending(self, pending, chunk_size=500, refresh=False):
+        """Runs the rules once for each pending visit.
+
+        Visits are updated together in chunks of `chunk_size` as update_many
+        does, whether all rules or only those of some source models run.
+        If `refresh` is True the visits are re-fetched from the database
+        first, see PendingVisits.refresh."""
+        if refresh:
+            pending.refresh()
+        visits = pending.pop_all()
+        for index in range(0, len(visits), chunk_size):
+            self._update_many(visits[index:index + chunk_size])
+
     def update_all(self, visit_model_instance):
         """Given a visit model instance, run all rules in each rule group
-        for the app_label of the visit model."""
-        app_label = visit_model_instance._meta.app_label
-        for rule_group in self.registry.get(app_label):
-            for rule in rule_group.rules:
-                rule.run(visit_model_instance)
+        for the app_label of the visit model.
+
+        Returns the visit context used for the pass or None if deferred."""
+        if self.defer(visit_model_instance):
+            return None
+        return self._update_all(visit_model_instance)
+
+    def _update_all(self, visit_model_instance):
+        with VisitContext(visit_model_instance, batch=True) as context:
+            for rule in self.get_rules_for_visit(visit_model_instance):
+                rule.run(visit_model_instance, context=context)
+        return context
+
+    def update_many(self, visit_model_instances):
+        """Runs all rules for each visit model instance as update_all does.
+
+        Registered subjects and metadata are loaded for all visits
+        together and metadata updates for all visits are written in bulk
+        at the end. Returns the visit contexts used."""
+        return self._update_many([(visit_model_instance, [None]) for visit_model_instance in visit_model_instances])
+
+    def _update_many(self, visits):
+        """Runs the rules for a list of (visit_model_instance, source_models)
+        sharing one metadata read and one bulk write.
+
+        A source model of None runs all rules for the visit."""
+        writer = MetadataWriter()
+        contexts = VisitContext.for_visits([visit_model_instance for visit_model_instance, _ in visits], writer=writer)
+        for context, (_, source_models) in zip(contexts, visits):
+            if None in source_models:
+                rules = self.get_rules_for_visit(context.visit)
+            else:
+                rules = self.get_rules_for_source_models(
+                    self.sort_source_models(source_models, context.visit), context.visit)
+            with context:
+                for rule in rules:
+                    rule.run(context.visit, context=context)
+        writer.flush()
+        return contexts
+
+    def get_entry_statuses(self, visit_model_instance, target_models=None, context=None):
+        """Returns a dictionary of {(target model, panel_name): entry_status}
+        computed by the rules for the visit without updating metadata.
+
+        If `target_models` is given only the rules governing those models
+        are run, found through the target model index. Targets that are
+        keyed are KEYED. Where several rules govern a target the last to
+        run decides, as when the rules update metadata."""
+        rules = self.get_rules_for_visit(visit_model_instance)
+        if target_models is not None:
+            app_label = visit_model_instance._meta.app_label
+            governing = set()
+            for target_model in target_models:
+                governing.update(self.get_rules_for_target_model(target_model, app_label))
+            rules = [rule for rule in rules if rule in governing]
+        entry_statuses = {}
+        with visit_context(visit_model_instance, context) as context:
+            for rule in rules:
+                entry_statuses.update(rule.get_entry_statuses(visit_model_instance, context=context))
+        if target_models is not None:
+            target_models = set('.'.join(model_key(target_model)) for target_model in target_models)
+            entry_statuses = {
+                key: entry_status for key, entry_status in entry_statuses.items() if key[0] in target_models}
+        return entry_statuses
+
+    def get_source_models_for_visit_definition(self, visit_instance):
+        """Returns a list of source models in order of the entries of the visit definition."""
+        CrfEntry = django_apps.get_model('edc_metadata', 'CrfEntry')
+        return [entry.get_model() for entry in CrfEntry.objects.filter(
+            visit_definition__code=visit_instance.appointment.visit_definition.code).order_by('entry_order')]
+
+    def get_entry_order(self, visit_instance):
+        """Returns a dictionary of {model key: position} of the source models
+        in order of the entries of the visit definition.
+
+        Empty if the entries of the visit definition cannot be found."""
+        try:
+            source_models = self.get_source_models_for_visit_definition(visit_instance)
+        except (LookupError, AttributeError):
+            return {}
+        return {model_key(source_model): index for index, source_model in enumerate(source_models)}
+
+    def sort_source_models(self, source_models, visit_instance):
+        """Returns a list of the source models in order of the entries of
+        the visit definition, e.g. for source models saved in another
+        order. Models without an entry follow in the order given."""
+        if len(source_models) < 2:
+            return list(source_models)
+        entry_order = self.get_entry_order(visit_instance)
+        return sorted(source_models, key=lambda source_model: entry_order.get(
+            model_key(source_model), len(entry_order)))
 
     def update_for_visit_definition(self, visit_instance):
         """Given a visit model instance, run all rules in the rule group
-        module for the visit definition in order of the entries (rule source model)."""
-        CrfEntry = apps.get_model('edc_metadata', 'CrfEntry')
-        for entry in CrfEntry.objects.filter(
-                visit_definition__code=visit_instance.appointment.visit_definition.code).order_by('entry_order'):
-            source_model = entry.get_model()
-            for rule in self.get_rules_for_source_model(source_model, visit_instance._meta.app_label):
-                rule.run(visit_instance)
-
-    def update_rules_for_source_model(self, source_model, visit_instance):
-        """Runs all rules that have a reference to the given source model (rule.source_model)."""
-        for rule in self.get_rules_for_source_model(source_model, visit_instance._meta.app_label):
-            rule.run(visit_instance)
+        module for the visit definition in order of the entries (rule source model).
+
+        Rules of a source model downstream of another run after it, see
+        get_downstream_models."""
+        return self.update_for_source_models(
+            self.get_source_models_for_visit_definition(visit_instance), visit_instance)
+
+    def update_for_source_models(self, source_models, visit_instance):
+        """Runs the rules for each source model, and for every model
+        downstream of them in the dependency graph, in one pass over
+        the visit in topological order."""
+        with VisitContext(visit_instance, batch=True) as context:
+            for rule in self.get_rules_for_source_models(source_models, visit_instance):
+                rule.run(visit_instance, context=context)
+        return context
+
+    def get_rules_for_source_models(self, source_models, visit_instance):
+        """Returns a list of the rules of the source models and of every model
+        downstream of them, in topological order."""
+        app_label = visit_instance._meta.app_label
+        return [
+            rule for source_key in self.get_downstream_models(source_models)
+            for rule in self.get_rules_for_source_model(source_key, app_label)]
+
+    def update_rules_for_source_model(self, source_model, visit_instance, instance=None):
+        """Runs all rules that have a reference to the given source model (rule.source_model)
+        and then the rules of the models downstream of their target models in
+        topological order.
+
+        If the saved source model `instance` is given, or changes are tracked
+        and an instance of the source model for the visit is being saved in
+        this thread, rules that only read fields that did not change in the
+        save are skipped."""
+        if instance is None and self.track_changes:
+            instance = self.get_saved_instance(source_model, visit_instance)
+        if self.defer(visit_instance, source_model):
+            return None
+        changed_fields = None
+        if instance is not None:
+            changed_fields = field_tracker.changed_fields(instance)
+        app_label = visit_instance._meta.app_label
+        rules = [
+            rule for rule in self.get_rules_for_source_model(source_model, app_label)
+            if rule.is_triggered_by(changed_fields)]
+        target_models = [target_model for rule in rules for target_model in rule.target_models]
+        with VisitContext(visit_instance, batch=True) as context:
+            for rule in rules:
+                rule.run(visit_instance, context=context)
+            for source_key in self.get_downstream_models(target_models):
+                if source_key != model_key(source_model):
+                    for rule in self.get_rules_for_source_model(source_key, app_label):
+                        rule.run(visit_instance, context=context)
+        return context
+
+    def get_saved_instance(self, source_model, visit_instance):
+        """Returns the source model instance of the visit being saved in this
+        thread or None."""
+        try:
+            model = django_apps.get_model(*model_key(source_model))
+        except LookupError:
+            return None
+        instance = field_tracker.pop_saved(model)
+        try:
+            if instance is not None and instance.visit.pk == visit_instance.pk:
+                return instance
+        except AttributeError:
+            pass
+        return None
 
     def update_rules_for_source_fk_model(self, source_fk_model, visit_instance):
         """Runs all rules that have a reference to the given source FK model (rule.source_fk_model)."""
-        for rule in self.get_rules_for_source_fk_model(source_fk_model, visit_instance._meta.app_label):
-            rule.run(visit_instance)
+        with VisitContext(visit_instance, batch=True) as context:
+            for rule in self.get_rules_for_source_fk_model(source_fk_model, visit_instance._meta.app_label):
+                rule.run(visit_instance, context=context)
+        return context
+
+    def get_rules_for_visit(self, visit_instance):
+        """Returns a list of rules that may apply to the visit code of
+        the given visit model instance."""
+        app_label = visit_instance._meta.app_label
+        try:
+            return self.visit_code_index[(app_label, visit_instance.visit_code)]
+        except (KeyError, AttributeError):
+            return self.visit_code_index.get((app_label, None), [])
 
     def get_rules_for_source_model(self, source_model, app_label):
         """Returns a list of rules for the given source_model."""
-        rules = []
-        for rule_group in self.registry.get(app_label):
-            for rule in rule_group.rules:
-                if rule.source_model == source_model:
-                    if rule.runif:
-                        rules.append(rule)
-        return rules
+        return self.source_model_index.get((app_label, model_key(source_model)), [])
+
+    def get_rules_for_target_model(self, target_model, app_label):
+        """Returns a list of rules that have the given model in target_models."""
+        return self.target_model_index.get((app_label, model_key(target_model)), [])
 
     def get_rules_for_registered_subject(self, app_label):
         """Returns a list of rules for the given source_fk_model."""
@@ -90,12 +552,45 @@ class SiteRuleGroups(object):
 
     def get_rules_for_source_fk_model(self, source_fk_model, app_label):
         """Returns a list of rules for the given source_fk_model."""
-        rules = []
-        for rule_group in self.registry.get(app_label):
-            for rule in rule_group.rules:
-                if rule.source_fk_model == source_fk_model:
-                    rules.append(rule)
-        return rules
+        return self.source_fk_model_index.get((app_label, model_key(source_fk_model)), [])
+
+    def get_registry_size(self):
+        """Returns the approximate size in bytes of the registered rules,
+        their logic and predicates.
+
+        Objects shared between rules are counted once. Model classes,
+        panels and other referenced objects are counted shallowly."""
+        seen = set()
+        size = 0
+        objs = [self.registry]
+        while objs:
+            obj = objs.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            if isinstance(obj, RuleGroupMeta):
+                objs.append(obj._meta.rules)
+            elif not isinstance(obj, type):
+                size += sys.getsizeof(obj)
+                objs.extend(self.get_referents(obj))
+        return size
+
+    @staticmethod
+    def get_referents(obj):
+        """Returns a list of the objects referenced by a container, rule,
+        logic or predicate to count in get_registry_size."""
+        if isinstance(obj, dict):
+            return list(obj.keys()) + list(obj.values())
+        if isinstance(obj, (list, tuple, set, frozenset)):
+            return list(obj)
+        if not isinstance(obj, (Rule, Logic, BasePredicate)):
+            return []
+        referents = [obj.__dict__] if hasattr(obj, '__dict__') else []
+        for klass in type(obj).__mro__:
+            for slot in getattr(klass, '__slots__', ()):
+                if hasattr(obj, slot):
+                    referents.append(getattr(obj, slot))
+        return referents
 
     def autodiscover(self, module_name=None):
         """Autodiscovers classes in the visit_schedules.py file of any INSTALLED_APP."""
@@ -105,11 +600,13 @@ class SiteRuleGroups(object):
             try:
                 mod = import_module(app)
                 try:
-                    before_import_registry = copy.copy(site_rule_groups.registry)
+                    before_import_registry = OrderedDict(
+                        (k, copy.copy(v)) for k, v in self.registry.items())
                     import_module('{}.{}'.format(app, module_name))
                 except Exception as e:
                     if 'No module named \'{}.{}\''.format(app, module_name) not in str(e):
-                        site_rule_groups.registry = before_import_registry
+                        self.registry = before_import_registry
+                        self._rebuild_indexes()
                         if module_has_submodule(mod, module_name):
                             raise
                 else:
@@ -0,0 +1,64 @@
+from django.core.exceptions import FieldDoesNotExist, FieldError
+
+
+class SourceQueryset:
+
+    """A lazy handle on the source model instances of a subject.
+
+    The queryset is not built until a predicate uses it. Iterating
+    streams instances from the database instead of caching them and
+    `iter_values` fetches only the column a predicate reads. Indexing,
+    slicing, `in` and any other attribute are delegated to the
+    underlying queryset.
+    """
+
+    def __init__(self, model, subject_identifier):
+        self.model = model
+        self.subject_identifier = subject_identifier
+        self._queryset = None
+
+    def __repr__(self):
+        return '<{}({}, {})>'.format(
+            self.__class__.__name__, self.model._meta.label_lower, self.subject_identifier)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') or attr == '_queryset':
+            raise AttributeError(attr)
+        return getattr(self.queryset, attr)
+
+    def __iter__(self):
+        return self.queryset.iterator()
+
+    def __len__(self):
+        return self.queryset.count()
+
+    def __bool__(self):
+        return self.queryset.exists()
+
+    def __getitem__(self, index):
+        return self.queryset[index]
+
+    def __contains__(self, obj):
+        return obj in self.queryset
+
+    @property
+    def queryset(self):
+        if self._queryset is None:
+            try:
+                self._queryset = self.model.objects.filter(subject_identifier=self.subject_identifier)
+            except FieldError:
+                self._queryset = self.model.objects.get_for_subject_identifier(self.subject_identifier)
+        return self._queryset
+
+    def iter_values(self, attr):
+        """Returns an iterator of the value of `attr` for each instance.
+
+        If `attr` is a concrete, non-relational field only its column is
+        selected, otherwise whole instances are streamed."""
+        try:
+            field = self.model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            field = None
+        if field is not None and field.concrete and not field.is_relation:
+            return self.queryset.values_list(attr, flat=True).iterator()
+        return (getattr(obj, attr) for obj in self.queryset.iterator())
@@ -1,7 +1,17 @@
 from dateutil.relativedelta import relativedelta
+from io import StringIO
+from uuid import uuid4
+import copy
+import numpy as np
+import os
+import tempfile
 
 from django.apps import apps as django_apps
-from django.test import TestCase, tag
+from django.core.management import call_command
+from django.db.models import Q
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, tag
+from unittest import mock, skipIf
 from model_mommy import mommy
 
 from edc_base.utils import get_utcnow
@@ -13,11 +23,23 @@ from edc_example.models import (
 from edc_metadata.constants import NOT_REQUIRED, REQUIRED, KEYED
 from edc_metadata.models import CrfMetadata
 from edc_rule_groups.crf_rule import CrfRule
-from edc_rule_groups.exceptions import RuleError
+from edc_rule_groups.exceptions import RequisitionRuleGroupErrror, RuleError
+from edc_rule_groups.field_tracker import field_tracker
 from edc_rule_groups.logic import Logic
-from edc_rule_groups.predicate import P, PF
+from edc_rule_groups.metadata_writer import MetadataWriter
+from edc_rule_groups.models import RuleJob
+from edc_rule_groups.pending_visits import PendingVisits
+from edc_rule_groups import parallel
+from edc_rule_groups.parallel import get_shards, update_parallel, update_shard
+from edc_rule_groups.predicate import (
+    And, Not, Or, P, PF, PredicateError, get_predicate_key, get_stats_key)
+from edc_rule_groups.predicate_stats import predicate_stats
+from edc_rule_groups.queues import DatabaseQueue
+from edc_rule_groups.requisition_rule import RequisitionRule
 from edc_rule_groups.rule_group import RuleGroup
-from edc_rule_groups.site_rule_groups import site_rule_groups, AlreadyRegistered
+from edc_rule_groups.site_rule_groups import site_rule_groups, AlreadyRegistered, SiteRuleGroups
+from edc_rule_groups.vectorized import evaluate_predicate, evaluate_rule_group, Row
+from edc_rule_groups.visit_context import VisitContext
 from edc_visit_schedule.site_visit_schedules import site_visit_schedules
 
 edc_registration_app_config = django_apps.get_app_config('edc_registration')
@@ -144,6 +166,76 @@ class RuleGroupTests(TestCase):
 
         self.assertRaises(AlreadyRegistered, site_rule_groups.register, ExampleCrfRuleGroup)
 
+    def test_register_compiles_rules(self):
+        """Asserts rules are compiled when registered and a misconfigured
+        rule raises instead of failing on the first save."""
+        for rule_group in site_rule_groups.get('edc_example'):
+            for rule in rule_group._meta.rules:
+                self.assertEqual(
+                    [model._meta.label_lower for model in rule.plan.target_models], list(rule.target_models))
+
+        class ExampleBadRuleGroup(RuleGroup):
+
+            crfs_bad = CrfRule(
+                logic=Logic(
+                    predicate=P('gender', 'eq', MALE),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_models=['crfdoesnotexist'])
+
+            class Meta:
+                app_label = 'edc_example'
+
+        self.assertRaises(RuleError, site_rule_groups.register, ExampleBadRuleGroup)
+        self.assertIsNone(site_rule_groups.get_rule_group('edc_example.examplebadrulegroup'))
+
+    def test_requisition_rule_panels_validated_on_register(self):
+        """Asserts target panels are validated when the rule group is registered."""
+
+        class ExampleBadRequisitionRuleGroup(RuleGroup):
+
+            requisition = RequisitionRule(
+                logic=Logic(
+                    predicate=P('gender', 'eq', MALE),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_model='subjectrequisition',
+                target_panels=[self.panel_name])
+
+            class Meta:
+                app_label = 'edc_example'
+
+        self.assertRaises(RequisitionRuleGroupErrror, site_rule_groups.register, ExampleBadRequisitionRuleGroup)
+
+    def test_abstract_rules_share_logic(self):
+        """Asserts rules inherited from an abstract rule group share the
+        parent's logic and rules have no instance __dict__."""
+
+        class ExampleAbstractRuleGroup(RuleGroup):
+
+            crfs_male = CrfRule(
+                logic=Logic(
+                    predicate=P('gender', 'eq', MALE),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_models=['crffour', 'crffive'])
+
+            class Meta:
+                abstract = True
+
+        class ExampleInheritedRuleGroup(ExampleAbstractRuleGroup):
+
+            class Meta:
+                app_label = 'edc_example'
+
+        rule = ExampleInheritedRuleGroup._meta.rules[0]
+        self.assertIsNot(rule, ExampleAbstractRuleGroup.crfs_male)
+        self.assertIs(rule.logic, ExampleAbstractRuleGroup.crfs_male.logic)
+        self.assertEqual(rule.target_models, ['edc_example.crffour', 'edc_example.crffive'])
+        for obj in [rule, rule.logic, rule.logic.predicate]:
+            self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertGreater(site_rule_groups.get_registry_size(), 0)
+
     def test_example2(self):
         """Asserts CrfTwo is REQUIRED if f1==\'car\' as specified
         by edc_example.rule_groups.ExampleRuleGroup2."""
@@ -178,6 +270,26 @@ class RuleGroupTests(TestCase):
         self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, NOT_REQUIRED)
         self.assertEqual(CrfMetadata.objects.get(model=CrfThree._meta.label_lower).entry_status, REQUIRED)
 
+    def test_metadata_writer_flushes_in_batches(self):
+        """Asserts the writer flushes more rows than fit in one statement
+        in batches of batch_size rows."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        writer = MetadataWriter()
+        for index in range(1200):
+            visit = mock.Mock(subject_identifier='999-{}'.format(index), visit_code=subject_visit.visit_code)
+            writer.update(visit, CrfTwo._meta.label_lower, entry_status=NOT_REQUIRED)
+        writer.update(subject_visit, CrfTwo._meta.label_lower, entry_status=NOT_REQUIRED)
+        with self.assertNumQueries(13):
+            self.assertEqual(writer.flush(), 1)
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, NOT_REQUIRED)
+
     def test_example4(self):
         """Asserts CrfThree is REQUIRED if f1==\'bicycle\' but then not when f1 is changed to \'car\' as specified
         by edc_example.rule_groups.ExampleRuleGroup2."""
@@ -323,3 +435,818 @@ class RuleGroupTests(TestCase):
         crf_one.delete()
         self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, NOT_REQUIRED)
         self.assertEqual(CrfMetadata.objects.get(model=CrfThree._meta.label_lower).entry_status, NOT_REQUIRED)
+
+    def test_indexes(self):
+        """Asserts every registered rule can be found in the lookup indexes."""
+        for app_label, rule_groups in site_rule_groups.registry.items():
+            for rule_group in rule_groups:
+                for rule in rule_group._meta.rules:
+                    self.assertIn(rule, site_rule_groups.get_rules_for_source_model(rule.source_model, app_label))
+                    for target_model in rule.target_models:
+                        self.assertIn(rule, site_rule_groups.get_rules_for_target_model(target_model, app_label))
+
+    def test_visit_context_loads_once(self):
+        """Asserts the visit context fetches the registered subject and source obj once."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        source_model = CrfOne._meta.label_lower.split('.')
+        with VisitContext(subject_visit) as context:
+            registered_subject = context.registered_subject
+            source_obj = context.get_source_obj(source_model)
+            with self.assertNumQueries(0):
+                self.assertEqual(context.registered_subject, registered_subject)
+                self.assertEqual(context.get_source_obj(source_model), source_obj)
+        self.assertEqual(context._source_objs, {})
+
+    def test_metadata_writer_last_writer_wins(self):
+        """Asserts the writer keeps the last status collected for a model and writes it on flush."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        writer = MetadataWriter()
+        writer.update(subject_visit, CrfTwo._meta.label_lower, entry_status=REQUIRED)
+        writer.update(subject_visit, CrfThree._meta.label_lower, entry_status=REQUIRED)
+        writer.update(subject_visit, CrfTwo._meta.label_lower, entry_status=NOT_REQUIRED)
+        writer.update(subject_visit, CrfThree._meta.label_lower, entry_status=None)
+        self.assertEqual(len(writer), 2)
+        with self.assertNumQueries(1):
+            writer.flush()
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, NOT_REQUIRED)
+        self.assertEqual(CrfMetadata.objects.get(model=CrfThree._meta.label_lower).entry_status, REQUIRED)
+
+    def test_visit_context_keyed(self):
+        """Asserts the visit context reads keyed CRFs from the metadata."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfThree.objects.create(subject_visit=subject_visit)
+        with VisitContext(subject_visit) as context:
+            with self.assertNumQueries(2):
+                self.assertTrue(context.is_keyed(CrfThree._meta.label_lower))
+                self.assertFalse(context.is_keyed(CrfTwo._meta.label_lower))
+
+    def test_visit_context_ignores_do_nothing(self):
+        """Asserts a None (DO_NOTHING) entry_status is not written with or without a writer."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        for batch in [False, True]:
+            with VisitContext(subject_visit, batch=batch) as context:
+                with self.assertNumQueries(0):
+                    context.update_metadata(CrfTwo._meta.label_lower, entry_status=None)
+
+    def test_visit_context_suppresses_unchanged_writes(self):
+        """Asserts re-running the rules does not rewrite unchanged metadata."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        entry_statuses = dict(CrfMetadata.objects.values_list('model', 'entry_status'))
+        context = site_rule_groups.update_all(subject_visit)
+        self.assertGreater(context.suppressed_writes, 0)
+        self.assertEqual(dict(CrfMetadata.objects.values_list('model', 'entry_status')), entry_statuses)
+
+    def test_get_entry_statuses(self):
+        """Asserts computed entry_statuses match the metadata written by the
+        rules and that computing them writes nothing."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        stored = dict(CrfMetadata.objects.filter(
+            subject_identifier=subject_visit.subject_identifier,
+            visit_code=subject_visit.visit_code).values_list('model', 'entry_status'))
+        entry_statuses = site_rule_groups.get_entry_statuses(subject_visit)
+        self.assertTrue(entry_statuses)
+        for (model, panel_name), entry_status in entry_statuses.items():
+            if panel_name is None:
+                self.assertEqual(stored[model], entry_status)
+        self.assertEqual(
+            site_rule_groups.get_entry_statuses(subject_visit, target_models=[CrfTwo]),
+            {key: value for key, value in entry_statuses.items() if key[0] == CrfTwo._meta.label_lower})
+        self.assertEqual(dict(CrfMetadata.objects.filter(
+            subject_identifier=subject_visit.subject_identifier,
+            visit_code=subject_visit.visit_code).values_list('model', 'entry_status')), stored)
+
+    def test_predicate_evaluated_once_per_rule(self):
+        """Asserts each rule's predicate is evaluated at most once in a pass
+        regardless of the number of target models."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        context = site_rule_groups.update_all(subject_visit)
+        self.assertGreater(context.predicate_evaluations, 0)
+        self.assertLessEqual(
+            context.predicate_evaluations, len(site_rule_groups.get_rules_for_visit(subject_visit)))
+
+    def test_equal_predicates_evaluated_once(self):
+        """Asserts structurally equal predicates share a key and are evaluated
+        once per pass for rules with the same source model."""
+        self.assertEqual(
+            get_predicate_key(P('gender', 'eq', MALE)), get_predicate_key(P('gender', 'eq', MALE)))
+        self.assertNotEqual(
+            get_predicate_key(P('gender', 'eq', MALE)), get_predicate_key(P('gender', 'eq', FEMALE)))
+        self.assertNotEqual(get_predicate_key(P('f1', 'is', True)), get_predicate_key(P('f1', 'is', 1)))
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        rules = [
+            CrfRule(
+                logic=Logic(
+                    predicate=P('gender', 'eq', MALE),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_models=[target_model])
+            for target_model in ['edc_example.crffour', 'edc_example.crffive']]
+        with VisitContext(subject_visit) as context:
+            for rule in rules:
+                self.assertEqual(context.evaluate(rule, context.registered_subject, None, None), REQUIRED)
+            self.assertEqual(context.predicate_evaluations, 1)
+
+    def test_source_qs_is_lazy(self):
+        """Asserts the source queryset is not queried until a predicate reads from it."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        with VisitContext(subject_visit) as context:
+            with self.assertNumQueries(0):
+                source_qs = context.get_source_qs(CrfOne._meta.label_lower.split('.'))
+            with self.assertNumQueries(1):
+                self.assertTrue(P('f1', 'eq', 'car')(None, None, None, source_qs))
+            crf_one = source_qs[0]
+            self.assertEqual(crf_one.f1, 'car')
+            self.assertEqual(list(source_qs[:1]), [crf_one])
+            self.assertIn(crf_one, source_qs)
+
+    def test_predicate_resolution_plan(self):
+        """Asserts how each arg supplies an attr is cached per attr and arg
+        types without changing the value found."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        crf_one = CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        registered_subject = edc_registration_app_config.model.objects.get(
+            subject_identifier=subject_visit.subject_identifier)
+        predicate = P('f1', 'eq', 'car')
+        args = (subject_visit, registered_subject, crf_one, None)
+        for _ in range(2):
+            self.assertTrue(predicate(*args))
+        plan = P.resolution_plans[('f1', tuple(type(arg) for arg in args))]
+        self.assertEqual(plan[2:], ['attr', 'skip'])
+        crf_one.f1 = None
+        self.assertIsNone(predicate.get_value(*args, attr='f1'))
+        self.assertTrue(predicate(subject_visit, registered_subject, None, CrfOne.objects.all()))
+        self.assertTrue(P('gender', 'eq', MALE)(*args))
+
+    def test_predicate_resolution_plan_property(self):
+        """Asserts an arg whose class defines the attr is not skipped after
+        the attr raised AttributeError for another instance."""
+
+        class Obj:
+
+            def __init__(self, f1=None):
+                self._f1 = f1
+
+            @property
+            def f1(self):
+                if self._f1 is None:
+                    raise AttributeError('f1')
+                return self._f1
+
+        predicate = P('f1', 'eq', 'car')
+        self.assertFalse(predicate(None, None, Obj(), None))
+        self.assertTrue(predicate(None, None, Obj('car'), None))
+
+    def test_predicate_as_q(self):
+        self.assertEqual(str(P('gender', 'eq', MALE).as_q()), str(Q(gender__exact=MALE)))
+        self.assertEqual(str(P('age', '<=', 64).as_q()), str(Q(age__lte=64)))
+        self.assertEqual(str(P('f1', 'is', None).as_q(prefix='crfone')), str(Q(crfone__f1__isnull=True)))
+        self.assertEqual(str(P('f1', 'is not', None).as_q()), str(Q(f1__isnull=False)))
+        self.assertEqual(str(P('gender', '!=', MALE).as_q()), str(~Q(gender__exact=MALE)))
+        self.assertRaises(PredicateError, P('f1', 'is', 'car').as_q)
+        self.assertRaises(PredicateError, PF('f1', func=lambda x: x).as_q)
+
+    def test_composite_predicates(self):
+        """Asserts And/Or/Not short-circuit and are ordered by loaded statistics."""
+        calls = []
+
+        def func(value):
+            calls.append(value)
+            return value == 'car'
+
+        obj = Row({'f1': ['car'], 'f2': ['helmet']}, 0)
+        predicate = And(P('f2', 'eq', 'gloves'), PF('f1', func=func))
+        self.assertFalse(predicate(obj, None, None, None))
+        self.assertEqual(calls, [])
+        self.assertTrue(Or(PF('f1', func=func), P('f2', 'eq', 'gloves'))(obj, None, None, None))
+        self.assertTrue(Not(P('f2', 'eq', 'gloves'))(obj, None, None, None))
+        self.assertEqual(predicate.attrs, ('f2', 'f1'))
+        self.assertEqual(
+            str(And(P('f1', 'eq', 'car'), Not(P('f2', 'eq', 'helmet'))).as_q()),
+            str(Q(f1__exact='car') & ~Q(f2__exact='helmet')))
+        self.assertRaises(PredicateError, And(P('f1', 'eq', 'car'), PF('f1', func=func)).as_q)
+        predicate = And(PF('f1', func=func), P('f2', 'eq', 'gloves'))
+        self.assertEqual([p for p, _ in predicate.ordered], list(predicate.predicates))
+        predicate_stats.clear()
+        predicate_stats.enabled = True
+        try:
+            for _ in range(3):
+                predicate(obj, None, None, None)
+        finally:
+            predicate_stats.enabled = False
+        path = os.path.join(tempfile.mkdtemp(), 'predicate_stats.json')
+        predicate_stats.save(path)
+        predicate_stats.load(path)
+        self.assertEqual([p for p, _ in predicate.ordered], list(reversed(predicate.predicates)))
+        calls.clear()
+        self.assertFalse(predicate(obj, None, None, None))
+        self.assertEqual(calls, [])
+        predicate = And(PF('f1', func=func), P('f2', 'eq', 'gloves'), reorder=False)
+        self.assertEqual([p for p, _ in predicate.ordered], list(predicate.predicates))
+        predicate_stats.clear()
+        predicate_stats.loaded = {}
+        predicate_stats.version += 1
+
+    def test_predicate_stats_keys(self):
+        """Asserts functions declared in the same scope get different
+        statistics keys and functions with a closure get none."""
+        value = 'car'
+        is_car = PF('f1', func=lambda f1: f1 == 'car')
+        is_bicycle = PF('f1', func=lambda f1: f1 == 'bicycle')
+        is_value = PF('f1', func=lambda f1: f1 == value)
+        self.assertNotEqual(get_stats_key(is_car), get_stats_key(is_bicycle))
+        self.assertEqual(get_stats_key(is_car), get_stats_key(is_car))
+        self.assertIsNone(get_stats_key(is_value))
+        self.assertIsNone(get_stats_key(Or(is_car, is_value)))
+        obj = Row({'f1': ['bicycle']}, 0)
+        predicate_stats.clear()
+        predicate_stats.enabled = True
+        try:
+            Or(is_value, is_car)(obj, None, None, None)
+        finally:
+            predicate_stats.enabled = False
+        self.assertEqual(list(predicate_stats.stats), [get_stats_key(is_car)])
+        predicate_stats.clear()
+
+    def test_rule_filter_queryset(self):
+        """Asserts a rule evaluated in the database matches the rule evaluated per subject."""
+        SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        SubjectConsentFactory(subject_identifier='123456789-1', gender=FEMALE)
+        rule = CrfRule(
+            logic=Logic(
+                predicate=P('gender', 'eq', MALE),
+                consequence=REQUIRED,
+                alternative=NOT_REQUIRED),
+            target_models=['crffour'])
+        RegisteredSubject = edc_registration_app_config.model
+        registered_subjects = rule.filter_queryset(RegisteredSubject.objects.all())
+        for registered_subject in RegisteredSubject.objects.all():
+            self.assertEqual(
+                registered_subject in registered_subjects,
+                rule.logic.predicate(None, registered_subject, None, None))
+
+    def test_vectorized_matches_evaluate(self):
+        """Asserts the vectorized evaluation of a rule group matches Rule.evaluate row for row."""
+
+        class ExampleWhatIfRuleGroup(RuleGroup):
+
+            car = CrfRule(
+                logic=Logic(
+                    predicate=P('f1', 'eq', 'car'),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_models=['crftwo'])
+
+            bicycle = CrfRule(
+                logic=Logic(
+                    predicate=PF('f1', 'f2', func=lambda f1, f2: f1 == 'bicycle' and not f2),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_models=['crfthree'])
+
+            class Meta:
+                app_label = 'edc_example'
+                source_model = 'edc_example.crfone'
+
+        data = {
+            'f1': np.array(['car', 'bicycle', 'bicycle', None], dtype=object),
+            'f2': np.array([None, None, 'helmet', None], dtype=object)}
+        entry_statuses = evaluate_rule_group(ExampleWhatIfRuleGroup, data)
+        for rule in ExampleWhatIfRuleGroup._meta.rules:
+            for index in range(4):
+                self.assertEqual(
+                    entry_statuses[(rule.target_models[0], None)][index],
+                    rule.evaluate(Row(data, index), None, None, None))
+
+    def test_vectorized_short_circuits(self):
+        """Asserts a vectorized And/Or only evaluates a sub-predicate for
+        the rows not yet decided, as when evaluated row by row."""
+        data = {'x': np.array([None, 6, 3], dtype=object)}
+        self.assertEqual(
+            list(evaluate_predicate(And(P('x', 'is not', None), P('x', 'gt', 5)), data)),
+            [False, True, False])
+        self.assertEqual(
+            list(evaluate_predicate(Or(P('x', 'is', None), P('x', 'gt', 5)), data)),
+            [True, True, False])
+
+    def test_decision_table(self):
+        """Asserts rules testing the same attr for equality are compiled to a
+        decision table that decides as the rules do."""
+
+        class ExampleDecisionTableRuleGroup(RuleGroup):
+
+            car = CrfRule(
+                logic=Logic(
+                    predicate=P('f1', 'eq', 'car'),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_models=['crftwo'])
+
+            bicycle = CrfRule(
+                logic=Logic(
+                    predicate=P('f1', 'eq', 'bicycle'),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_models=['crfthree'])
+
+            not_car = CrfRule(
+                logic=Logic(
+                    predicate=P('f1', 'eq', 'car'),
+                    consequence=NOT_REQUIRED,
+                    alternative=REQUIRED),
+                target_models=['crffour'])
+
+            helmet = CrfRule(
+                logic=Logic(
+                    predicate=P('f2', '!=', 'helmet'),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_models=['crffive'])
+
+            class Meta:
+                app_label = 'edc_example'
+                source_model = 'crfone'
+
+        decision_tables = ExampleDecisionTableRuleGroup._meta.decision_tables
+        self.assertEqual(len(decision_tables), 1)
+        self.assertEqual(len(decision_tables[0].rules), 3)
+        self.assertIsNone(ExampleDecisionTableRuleGroup.helmet.decision_table)
+        data = {'f1': ['car', 'bicycle', 'bus', None]}
+        for index in range(4):
+            row = Row(data, index)
+            entry_statuses = decision_tables[0].evaluate(None, None, row, None)
+            for rule in decision_tables[0].rules:
+                self.assertEqual(entry_statuses[rule], rule.evaluate(None, None, row, None))
+
+    def test_rule_triggered_by_changed_fields(self):
+        """Asserts a rule is skipped if the fields it reads did not change."""
+        field_tracker.track(CrfOne)
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        crf_one = CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        self.assertIsNone(field_tracker.changed_fields(crf_one))
+        crf_one = CrfOne.objects.get(pk=crf_one.pk)
+        crf_one.save()
+        self.assertNotIn('f1', field_tracker.changed_fields(crf_one))
+        crf_one.f1 = 'bicycle'
+        crf_one.save()
+        self.assertIn('f1', field_tracker.changed_fields(crf_one))
+        self.assertIsNone(site_rule_groups.get_saved_instance(
+            CrfOne._meta.label_lower.split('.'), subject_visit))
+        for rule in site_rule_groups.get_rules_for_source_model(
+                CrfOne._meta.label_lower.split('.'), CrfOne._meta.app_label):
+            if rule.logic.attrs == ('f1', ):
+                self.assertTrue(rule.is_triggered_by({'f1'}))
+                self.assertFalse(rule.is_triggered_by({'f2'}))
+        logic = Logic(
+            predicate=lambda visit, registered_subject, source_obj, source_qs: True,
+            consequence=REQUIRED, alternative=NOT_REQUIRED)
+        self.assertIsNone(logic.attrs)
+        logic = Logic(
+            predicate=lambda visit, registered_subject, source_obj, source_qs: True,
+            consequence=REQUIRED, alternative=NOT_REQUIRED, attrs=['f1'])
+        self.assertEqual(logic.attrs, ('f1', ))
+
+    def test_dependency_graph(self):
+        """Asserts models downstream of a source model are found in
+        topological order and cycles are reported."""
+        site = SiteRuleGroups()
+
+        def make_rule_group(name, source_model, target_model):
+            meta = type('Meta', (), {'app_label': 'edc_example', 'source_model': source_model})
+            rule = CrfRule(
+                logic=Logic(
+                    predicate=P('f1', 'eq', 'car'),
+                    consequence=REQUIRED,
+                    alternative=NOT_REQUIRED),
+                target_models=[target_model])
+            return type(name, (RuleGroup, ), {'rule': rule, 'Meta': meta})
+
+        site.register(make_rule_group('CrfTwoRuleGroup', 'edc_example.crftwo', 'crfthree'))
+        site.register(make_rule_group('CrfOneRuleGroup', 'edc_example.crfone', 'crftwo'))
+        self.assertEqual(
+            site.get_downstream_models(['edc_example.crfone']),
+            [('edc_example', 'crfone'), ('edc_example', 'crftwo'), ('edc_example', 'crfthree')])
+        self.assertEqual(
+            site.get_downstream_models(['edc_example.crftwo']),
+            [('edc_example', 'crftwo'), ('edc_example', 'crfthree')])
+        self.assertEqual(site.get_cycles(), [])
+        site.register(make_rule_group('CrfFourRuleGroup', 'edc_example.crffour', 'crfthree'))
+        self.assertEqual(
+            site.get_downstream_models(['edc_example.crffour', 'edc_example.crftwo']),
+            [('edc_example', 'crffour'), ('edc_example', 'crftwo'), ('edc_example', 'crfthree')])
+        self.assertEqual(
+            site.get_downstream_models(['edc_example.crftwo', 'edc_example.crffour']),
+            [('edc_example', 'crftwo'), ('edc_example', 'crffour'), ('edc_example', 'crfthree')])
+        self.assertEqual(
+            site.get_downstream_models(['edc_example.crfthree', 'edc_example.crfone']),
+            [('edc_example', 'crfone'), ('edc_example', 'crftwo'), ('edc_example', 'crfthree')])
+        site.register(make_rule_group('CrfThreeRuleGroup', 'edc_example.crfthree', 'crftwo'))
+        self.assertEqual(site.get_cycles(), [[('edc_example', 'crftwo'), ('edc_example', 'crfthree')]])
+
+    def test_rule_triggered_by_changed_fields_on_save(self):
+        """Asserts rules run on save with changes tracked use the changed
+        fields of the instance being saved, not of the previous save."""
+        field_tracker.track(CrfOne)
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        site_rule_groups.track_changes = True
+        try:
+            crf_one = CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+            self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, REQUIRED)
+            crf_one = CrfOne.objects.get(pk=crf_one.pk)
+            crf_one.save()
+            crf_one.f1 = 'bicycle'
+            crf_one.save()
+        finally:
+            site_rule_groups.track_changes = False
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, NOT_REQUIRED)
+
+    def test_visit_schedule_rule_caches_visit_codes(self):
+        """Asserts runif resolves the visit codes from the visit schedule once."""
+        rules = [rule for rule_group in site_rule_groups.get('edc_example') for rule in rule_group._meta.rules]
+        for rule in rules:
+            if isinstance(rule, CrfRule):
+                visit_code_set = rule.visit_code_set
+                self.assertIsInstance(visit_code_set, frozenset)
+                self.assertIs(rule.visit_code_set, visit_code_set)
+                rule.invalidate()
+                self.assertEqual(rule.visit_code_set, visit_code_set)
+                registry_token = rule._registry_token
+                CrfRule.schedules_changed()
+                self.assertEqual(rule.visit_code_set, visit_code_set)
+                self.assertNotEqual(rule._registry_token, registry_token)
+                registry_token = rule._registry_token
+                registry = site_visit_schedules.registry
+                site_visit_schedules.registry = type(registry)(registry)
+                try:
+                    self.assertEqual(rule.visit_code_set, visit_code_set)
+                    self.assertNotEqual(rule._registry_token, registry_token)
+                finally:
+                    site_visit_schedules.registry = registry
+
+    def test_visit_schedule_rule_subclass_schedule_names(self):
+        """Asserts the schedule names set on a subclass are not replaced by the constructor."""
+
+        class ScheduleCrfRule(CrfRule):
+            visit_schedule_name = 'visit_schedule1'
+            schedule_name = 'schedule1'
+
+        rule = ScheduleCrfRule(
+            logic=Logic(
+                predicate=P('f1', 'eq', 'car'),
+                consequence=REQUIRED,
+                alternative=NOT_REQUIRED),
+            target_models=['crftwo'])
+        self.assertEqual(rule.visit_schedule_name, 'visit_schedule1')
+        self.assertEqual(rule.schedule_name, 'schedule1')
+        self.assertIsNone(CrfRule(
+            logic=rule.logic, target_models=['crftwo']).visit_schedule_name)
+
+    def test_update_rule_groups_command(self):
+        """Asserts the management command re-runs the rules for existing visits."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        CrfMetadata.objects.filter(model=CrfTwo._meta.label_lower).update(entry_status=NOT_REQUIRED)
+        call_command('update_rule_groups', subject_visit._meta.label_lower, chunk_size=1, stdout=StringIO())
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, REQUIRED)
+
+    def test_get_shards(self):
+        shards = get_shards(['3', '1', '2', '5', '4'], 2)
+        self.assertEqual(shards, [['1', '3', '5'], ['2', '4']])
+        self.assertEqual(sorted(sum(get_shards(['3', '1', '2'], 5), [])), ['1', '2', '3'])
+
+    def test_update_parallel_single_worker(self):
+        """Asserts a sharded run updates metadata as a serial run does."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        CrfMetadata.objects.filter(model=CrfTwo._meta.label_lower).update(entry_status=NOT_REQUIRED)
+        total, _ = update_parallel(subject_visit._meta.label_lower, 1)
+        self.assertEqual(total, 1)
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, REQUIRED)
+
+    def test_update_shard_batches_subjects(self):
+        """Asserts visits are selected for a bounded number of subjects per query."""
+        subject_visits = []
+        for subject_identifier in ['123456789-0', '123456789-1', '123456789-2']:
+            subject_consent = SubjectConsentFactory(subject_identifier=subject_identifier, gender=MALE)
+            enrollment = EnrollmentFactory(
+                subject_identifier=subject_consent.subject_identifier,
+                schedule_name='schedule1')
+            appointment = Appointment.objects.get(
+                subject_identifier=enrollment.subject_identifier,
+                visit_code=self.first_visit.code)
+            subject_visits.append(SubjectVisitFactory(appointment=appointment))
+        subject_batch_size = parallel.subject_batch_size
+        parallel.subject_batch_size = 2
+        try:
+            total = update_shard(
+                subject_visits[0]._meta.label_lower,
+                [subject_visit.subject_identifier for subject_visit in subject_visits])
+        finally:
+            parallel.subject_batch_size = subject_batch_size
+        self.assertEqual(total, 3)
+
+    def test_defer_to_commit(self):
+        """Asserts rules for a visit are coalesced until the transaction commits."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        CrfMetadata.objects.filter(model=CrfTwo._meta.label_lower).update(entry_status=NOT_REQUIRED)
+        site_rule_groups.defer_to_commit = True
+        try:
+            source_model = CrfOne._meta.label_lower.split('.')
+            self.assertIsNone(site_rule_groups.update_rules_for_source_model(source_model, subject_visit))
+            self.assertIsNone(site_rule_groups.update_rules_for_source_model(source_model, subject_visit))
+            pending = site_rule_groups.get_pending_on_commit()
+            self.assertEqual(len(pending), 1)
+        finally:
+            site_rule_groups.defer_to_commit = False
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, NOT_REQUIRED)
+        site_rule_groups.update_pending(pending)
+        self.assertEqual(len(pending), 0)
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, REQUIRED)
+
+    def test_pending_visits_refresh(self):
+        """Asserts refreshing pending visits re-fetches each visit and drops
+        visits that no longer exist."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        missing_visit = copy.copy(subject_visit)
+        missing_visit.pk = uuid4()
+        pending = PendingVisits()
+        pending.add(subject_visit, ('edc_example', 'crfone'))
+        pending.add(missing_visit)
+        with self.assertNumQueries(1):
+            pending.refresh()
+        visits = pending.pop_all()
+        self.assertEqual(visits, [(subject_visit, [('edc_example', 'crfone')])])
+        self.assertIsNot(visits[0][0], subject_visit)
+
+    def test_update_pending_keeps_entry_order(self):
+        """Asserts the rules of unrelated source models pending for a visit
+        run in order of the entries of the visit definition, not in the
+        order the source models were saved."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        CrfThree.objects.create(subject_visit=subject_visit)
+        site = SiteRuleGroups()
+
+        def make_rule_group(name, source_model, predicate, consequence, alternative):
+            meta = type('Meta', (), {'app_label': 'edc_example', 'source_model': source_model})
+            rule = CrfRule(
+                logic=Logic(predicate=predicate, consequence=consequence, alternative=alternative),
+                target_models=['crffour'])
+            return type(name, (RuleGroup, ), {'rule': rule, 'Meta': meta})
+
+        site.register(make_rule_group(
+            'CrfOneRuleGroup', 'edc_example.crfone', P('f1', 'eq', 'car'), REQUIRED, NOT_REQUIRED))
+        site.register(make_rule_group(
+            'CrfThreeRuleGroup', 'edc_example.crfthree',
+            lambda visit, registered_subject, source_obj, source_qs: True, NOT_REQUIRED, REQUIRED))
+        for entries, entry_status in [([CrfThree, CrfOne], REQUIRED), ([CrfOne, CrfThree], NOT_REQUIRED)]:
+            pending = PendingVisits()
+            pending.add(subject_visit, ('edc_example', 'crfone'))
+            pending.add(subject_visit, ('edc_example', 'crfthree'))
+            with mock.patch.object(SiteRuleGroups, 'get_source_models_for_visit_definition', return_value=entries):
+                site.update_pending(pending)
+            self.assertEqual(CrfMetadata.objects.get(model=CrfFour._meta.label_lower).entry_status, entry_status)
+
+    def test_update_pending_batches_source_model_visits(self):
+        """Asserts visits pending for a source model are updated with one bulk write."""
+        subject_visits = []
+        for subject_identifier in ['123456789-0', '123456789-1']:
+            subject_consent = SubjectConsentFactory(subject_identifier=subject_identifier, gender=MALE)
+            enrollment = EnrollmentFactory(
+                subject_identifier=subject_consent.subject_identifier,
+                schedule_name='schedule1')
+            appointment = Appointment.objects.get(
+                subject_identifier=enrollment.subject_identifier,
+                visit_code=self.first_visit.code)
+            subject_visit = SubjectVisitFactory(appointment=appointment)
+            CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+            subject_visits.append(subject_visit)
+        CrfMetadata.objects.filter(model=CrfTwo._meta.label_lower).update(entry_status=NOT_REQUIRED)
+        pending = PendingVisits()
+        for subject_visit in subject_visits:
+            pending.add(subject_visit, ('edc_example', 'crfone'))
+        with mock.patch.object(MetadataWriter, 'flush', autospec=True, side_effect=MetadataWriter.flush) as flush:
+            site_rule_groups.update_pending(pending)
+        self.assertEqual(flush.call_count, 1)
+        self.assertEqual(
+            set(CrfMetadata.objects.filter(model=CrfTwo._meta.label_lower).values_list(
+                'entry_status', flat=True)), {REQUIRED})
+
+    def test_deferred(self):
+        """Asserts rules suspended in nested deferred blocks run once on exit, even if the block raises."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        CrfMetadata.objects.filter(model=CrfTwo._meta.label_lower).update(entry_status=NOT_REQUIRED)
+        with self.assertRaises(ValueError):
+            with site_rule_groups.deferred() as pending:
+                with site_rule_groups.deferred():
+                    self.assertIsNone(site_rule_groups.update_all(subject_visit))
+                    self.assertIsNone(site_rule_groups.update_rules_for_source_model(
+                        CrfOne._meta.label_lower.split('.'), subject_visit))
+                self.assertEqual(len(pending), 1)
+                self.assertEqual(
+                    CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, NOT_REQUIRED)
+                raise ValueError
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, REQUIRED)
+
+    def test_database_queue(self):
+        """Asserts queued rule runs are deduplicated per visit and run when the queue is drained."""
+        subject_consent = SubjectConsentFactory(subject_identifier='123456789-0', gender=MALE)
+        enrollment = EnrollmentFactory(
+            subject_identifier=subject_consent.subject_identifier,
+            schedule_name='schedule1')
+        appointment = Appointment.objects.get(
+            subject_identifier=enrollment.subject_identifier,
+            visit_code=self.first_visit.code)
+        subject_visit = SubjectVisitFactory(appointment=appointment)
+        CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        CrfMetadata.objects.filter(model=CrfTwo._meta.label_lower).update(entry_status=NOT_REQUIRED)
+        queue = DatabaseQueue()
+        site_rule_groups.queue = queue
+        try:
+            source_model = CrfOne._meta.label_lower.split('.')
+            site_rule_groups.update_rules_for_source_model(source_model, subject_visit)
+            site_rule_groups.update_rules_for_source_model(source_model, subject_visit)
+        finally:
+            site_rule_groups.queue = None
+        self.assertEqual(RuleJob.objects.count(), 1)
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, NOT_REQUIRED)
+        queue.join()
+        self.assertEqual(RuleJob.objects.count(), 0)
+        self.assertEqual(CrfMetadata.objects.get(model=CrfTwo._meta.label_lower).entry_status, REQUIRED)
+
+    def test_database_queue_failed_job(self):
+        """Asserts a job whose rules raise is kept with its error and does
+        not block the jobs queued after it."""
+        RuleJob.objects.create(visit_model='edc_example.subjectvisit', visit_pk='1')
+        RuleJob.objects.create(visit_model='edc_example.subjectvisit', visit_pk='2')
+        queue = DatabaseQueue()
+        with mock.patch.object(DatabaseQueue, 'run', side_effect=[ValueError('bad rule'), None]) as run:
+            self.assertEqual(queue.process(), 2)
+            self.assertEqual(queue.process(), 0)
+        self.assertEqual(run.call_count, 2)
+        job = RuleJob.objects.get()
+        self.assertEqual((job.visit_pk, job.error), ('1', 'ValueError: bad rule'))
+        visit_instance = mock.Mock(pk='1', _meta=mock.Mock(label_lower='edc_example.subjectvisit'))
+        queue.enqueue(visit_instance)
+        self.assertIsNone(RuleJob.objects.get().error)
+
+
+@skipIf(connection.vendor == 'sqlite' and not connection.settings_dict['TEST'].get('NAME'),
+        'The worker processes need a database shared between processes, '
+        'e.g. --settings=edc_rule_groups.settings_parallel.')
+class ParallelTests(TransactionTestCase):
+
+    def setUp(self):
+        visit_schedule = site_visit_schedules.get_visit_schedule(Enrollment._meta.visit_schedule_name)
+        self.first_visit = visit_schedule.get_schedule(Enrollment._meta.label_lower).get_first_visit()
+
+    def test_update_parallel_pool(self):
+        """Asserts a run in a pool of worker processes updates metadata as a serial run does."""
+        for subject_identifier in ['123456789-0', '123456789-1', '123456789-2']:
+            subject_consent = SubjectConsentFactory(subject_identifier=subject_identifier, gender=MALE)
+            enrollment = EnrollmentFactory(
+                subject_identifier=subject_consent.subject_identifier,
+                schedule_name='schedule1')
+            appointment = Appointment.objects.get(
+                subject_identifier=enrollment.subject_identifier,
+                visit_code=self.first_visit.code)
+            subject_visit = SubjectVisitFactory(appointment=appointment)
+            CrfOne.objects.create(subject_visit=subject_visit, f1='car')
+        CrfMetadata.objects.filter(model=CrfTwo._meta.label_lower).update(entry_status=NOT_REQUIRED)
+        total, _ = update_parallel(subject_visit._meta.label_lower, 2)
+        self.assertEqual(total, 3)
+        self.assertEqual(
+            set(CrfMetadata.objects.filter(model=CrfTwo._meta.label_lower).values_list(
+                'entry_status', flat=True)), {REQUIRED})
@@ -0,0 +1,178 @@
+"""Evaluates rule groups over columnar data without touching the database.
+
+For example, to simulate a rule change over a study export:
+
+    data = {'f1': np.array(['car', 'bicycle', None], dtype=object),
+            'gender': np.array([MALE, FEMALE, MALE])}
+    entry_statuses = evaluate_rule_group(ExampleRuleGroup2, data)
+    entry_statuses[('edc_example.crftwo', None)]
+    # array(['required', 'not_required', 'not_required'], dtype=object)
+
+Each row is one visit. The value of each predicate attr is read from
+the column of the same name.
+"""
+import operator
+
+from .constants import DO_NOTHING
+from .exceptions import RuleError
+from .predicate import And, Not, Or, P, PF, PredicateError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+operators = {
+    'gt': operator.gt,
+    '>': operator.gt,
+    'gte': operator.ge,
+    '>=': operator.ge,
+    'lt': operator.lt,
+    '<': operator.lt,
+    'lte': operator.le,
+    '<=': operator.le,
+    'eq': operator.eq,
+    'equals': operator.eq,
+    '==': operator.eq,
+    'neq': operator.ne,
+    '!=': operator.ne,
+}
+
+
+class Row:
+
+    """Exposes the values of one row of columnar data as attributes."""
+
+    def __init__(self, data, index):
+        self._data = data
+        self._index = index
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        try:
+            return self._data[attr][self._index]
+        except (KeyError, ValueError):
+            raise AttributeError(attr)
+
+
+def get_column(data, attr):
+    try:
+        return np.asarray(data[attr])
+    except (KeyError, ValueError):
+        raise PredicateError('Missing column for attr \'{}\'.'.format(attr))
+
+
+def get_length(data):
+    """Returns the number of rows in a dictionary of arrays or a structured array."""
+    try:
+        columns = data.values()
+    except AttributeError:
+        return len(data)
+    for column in columns:
+        return len(column)
+    return 0
+
+
+def get_rows(data, rows):
+    """Returns the data of the given rows only."""
+    try:
+        return {attr: np.asarray(column)[rows] for attr, column in data.items()}
+    except AttributeError:
+        return data[rows]
+
+
+def is_native(column, value):
+    """Returns True if numpy can compare the column with value directly."""
+    if column.dtype.kind in 'biuf':
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if column.dtype.kind == 'U':
+        return isinstance(value, str)
+    return False
+
+
+def evaluate_predicate(predicate, data):
+    """Returns a boolean array of the predicate evaluated for each row."""
+    if np is None:
+        raise PredicateError('Vectorized evaluation requires numpy.')
+    if isinstance(predicate, P):
+        column = get_column(data, predicate.attr)
+        if predicate.operator in operators and is_native(column, predicate.expected_value):
+            return np.asarray(operators[predicate.operator](column, predicate.expected_value), dtype=bool)
+        func = np.frompyfunc(predicate.func, 2, 1)
+        return func(column.astype(object), predicate.expected_value).astype(bool)
+    elif isinstance(predicate, PF):
+        columns = [get_column(data, attr).astype(object) for attr in predicate.attrs]
+        return np.frompyfunc(predicate.func, len(columns), 1)(*columns).astype(bool)
+    elif isinstance(predicate, (And, Or)):
+        return evaluate_composite(predicate, data)
+    elif isinstance(predicate, Not):
+        return ~evaluate_predicate(predicate.predicate, data)
+    return np.array(
+        [bool(predicate(Row(data, index), None, None, None)) for index in range(get_length(data))],
+        dtype=bool)
+
+
+def evaluate_composite(predicate, data):
+    """Returns a boolean array of an And or Or evaluated for each row.
+
+    As when evaluated row by row, each sub-predicate is only evaluated
+    for the rows the sub-predicates before it have not decided."""
+    stop_value = predicate.stop_value
+    mask = np.full(get_length(data), not stop_value, dtype=bool)
+    for sub_predicate, _ in predicate.ordered:
+        rows = np.flatnonzero(mask != stop_value)
+        if not len(rows):
+            break
+        mask[rows] = evaluate_predicate(sub_predicate, get_rows(data, rows))
+    return mask
+
+
+def evaluate_rule(rule, data):
+    """Returns an object array of the entry_status decided by the rule for
+    each row, None where the rule does nothing.
+
+    Row for row the same result as Rule.evaluate."""
+    try:
+        mask = evaluate_predicate(rule.logic.predicate, data)
+    except PredicateError:
+        raise
+    except Exception as e:
+        raise RuleError('An exception was raised when running rule {}. Got {}'.format(rule, str(e)))
+    consequence = None if rule.logic.consequence == DO_NOTHING else rule.logic.consequence
+    alternative = None if rule.logic.alternative == DO_NOTHING else rule.logic.alternative
+    entry_statuses = np.empty(len(mask), dtype=object)
+    entry_statuses[mask] = consequence
+    entry_statuses[~mask] = alternative
+    return entry_statuses
+
+
+def evaluate_rule_group(rule_group, data):
+    """Returns a dictionary of {(target_model, panel_name): entry_statuses}
+    for the rules of a rule group evaluated over columnar data.
+
+    `data` is a dictionary of arrays or a numpy structured array. If it
+    has a 'visit_code' column rules with visit_codes only apply to rows
+    with one of their visit codes. Where rules share a target the last
+    rule wins, as when rules run in sequence. Rows no rule decides are None.
+    """
+    results = {}
+    visit_codes = None
+    try:
+        visit_codes = get_column(data, 'visit_code')
+    except PredicateError:
+        pass
+    for rule in rule_group._meta.rules:
+        entry_statuses = evaluate_rule(rule, data)
+        applies = entry_statuses != None  # noqa
+        if visit_codes is not None and getattr(rule, 'visit_codes', None):
+            applies &= np.isin(visit_codes, list(rule.visit_codes))
+        panel_names = [panel.name for panel in getattr(rule, 'target_panels', None) or []] or [None]
+        for target_model in rule.target_models:
+            for panel_name in panel_names:
+                key = (target_model, panel_name)
+                if key not in results:
+                    results[key] = np.empty(len(entry_statuses), dtype=object)
+                results[key][applies] = entry_statuses[applies]
+    return results
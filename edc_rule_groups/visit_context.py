@@ -0,0 +1,244 @@
+from contextlib import contextmanager
+
+from django.apps import apps as django_apps
+from django.core.exceptions import ObjectDoesNotExist
+from edc_metadata.constants import KEYED
+
+from .metadata_writer import MetadataWriter
+from .source_queryset import SourceQueryset
+
+
+class VisitContext:
+
+    """Loads the objects rules evaluate against once per visit.
+
+    A single instance is shared by every rule run in a pass over a
+    visit so that the registered subject, the source model instance
+    and the source queryset are fetched once instead of once per rule.
+
+    Each rule's predicate is evaluated at most once per context, and
+    once for all rules with the same source model and structurally equal
+    predicates; `predicate_evaluations` counts the evaluations.
+
+    The current metadata entry_statuses of the visit are read once.
+    Updates that would not change a stored entry_status are skipped
+    and counted in `suppressed_writes`.
+
+    If `batch` is True metadata updates are collected and written in
+    bulk when the context exits. A `writer` may be passed instead to
+    collect updates for several visits; the caller then flushes it.
+    """
+
+    _registered_subject_model = None
+
+    def __init__(self, visit, batch=None, writer=None):
+        self.visit = visit
+        self.writer = writer
+        self._flush_on_exit = False
+        if batch and writer is None:
+            self.writer = MetadataWriter()
+            self._flush_on_exit = True
+        self._registered_subject = None
+        self._registered_subject_loaded = False
+        self._source_objs = {}
+        self._source_querysets = {}
+        self._metadata = None
+        self._decisions = {}
+        self._predicate_values = {}
+        self.predicate_evaluations = 0
+        self.suppressed_writes = 0
+
+    def __repr__(self):
+        return '<{}({})>'.format(self.__class__.__name__, self.visit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        try:
+            if self._flush_on_exit and exc_type is None:
+                self.writer.flush()
+        finally:
+            self.clear()
+
+    def clear(self):
+        """Discards everything loaded for the visit."""
+        self._registered_subject = None
+        self._registered_subject_loaded = False
+        self._source_objs = {}
+        self._source_querysets = {}
+        self._metadata = None
+        self._decisions = {}
+        self._predicate_values = {}
+
+    @staticmethod
+    def load_metadata(subject_identifiers, visit_codes):
+        """Returns a dictionary of {(subject_identifier, visit_code): {(model, panel_name): entry_status}}
+        read in one query per metadata model."""
+        metadata = {}
+        options = dict(subject_identifier__in=subject_identifiers, visit_code__in=visit_codes)
+        crf_metadata = django_apps.get_model(*MetadataWriter.crf_metadata_model.split('.'))
+        for subject_identifier, visit_code, model, entry_status in crf_metadata.objects.filter(
+                **options).values_list('subject_identifier', 'visit_code', 'model', 'entry_status'):
+            metadata.setdefault((subject_identifier, visit_code), {})[(model, None)] = entry_status
+        requisition_metadata = django_apps.get_model(*MetadataWriter.requisition_metadata_model.split('.'))
+        for subject_identifier, visit_code, model, panel_name, entry_status in requisition_metadata.objects.filter(
+                **options).values_list('subject_identifier', 'visit_code', 'model', 'panel_name', 'entry_status'):
+            metadata.setdefault((subject_identifier, visit_code), {})[(model, panel_name)] = entry_status
+        return metadata
+
+    @classmethod
+    def for_visits(cls, visits, writer=None):
+        """Returns a list of contexts for the visits with the registered
+        subjects and metadata of all visits loaded in a bounded
+        number of queries."""
+        contexts = [cls(visit, writer=writer) for visit in visits]
+        if not contexts:
+            return contexts
+        subject_identifiers = set(context.visit.subject_identifier for context in contexts)
+        visit_codes = set(context.visit.visit_code for context in contexts)
+        registered_subjects = {
+            obj.subject_identifier: obj for obj in cls.get_registered_subject_model().objects.filter(
+                subject_identifier__in=subject_identifiers)}
+        metadata = cls.load_metadata(subject_identifiers, visit_codes)
+        for context in contexts:
+            context._registered_subject = registered_subjects.get(context.visit.subject_identifier)
+            context._registered_subject_loaded = True
+            context._metadata = metadata.get((context.visit.subject_identifier, context.visit.visit_code), {})
+        return contexts
+
+    def evaluate(self, rule, *args):
+        """Returns the entry_status decided by the rule for the visit,
+        evaluating the rule's predicate only the first time.
+
+        Rules with the same source model and structurally equal
+        predicates share one evaluation. Rules in a decision table are
+        decided together by one lookup."""
+        try:
+            return self._decisions[rule]
+        except KeyError:
+            pass
+        if rule.decision_table is not None:
+            self._decisions.update(rule.decision_table.evaluate(self.visit, *args))
+            self.predicate_evaluations += 1
+            return self._decisions[rule]
+        key = (rule.plan.source_key, rule.plan.predicate_key)
+        try:
+            value = self._predicate_values[key]
+        except KeyError:
+            value = rule.evaluate_predicate(self.visit, *args)
+            self.predicate_evaluations += 1
+            self._predicate_values[key] = value
+        entry_status = rule.get_result(value)
+        self._decisions[rule] = entry_status
+        return entry_status
+
+    @property
+    def metadata(self):
+        """Returns a dictionary of {(model, panel_name): entry_status} of the
+        CRF and requisition metadata of the visit.
+
+        Read from the metadata tables in one query per metadata model
+        instead of querying each target model."""
+        if self._metadata is None:
+            self._metadata = self.load_metadata(
+                [self.visit.subject_identifier], [self.visit.visit_code]).get(
+                    (self.visit.subject_identifier, self.visit.visit_code), {})
+        return self._metadata
+
+    def is_keyed(self, model, panel_name=None):
+        """Returns True if the model (and panel) instance exists for the visit."""
+        return self.metadata.get((model, panel_name)) == KEYED
+
+    def update_metadata(self, model, entry_status=None, panel_name=None):
+        """Updates the metadata entry_status for a model (and panel) of the
+        visit or, if collecting, defers the update to the writer.
+
+        Does nothing if the entry_status is None (DO_NOTHING) or is
+        already stored."""
+        if entry_status is None:
+            return
+        key = (model, panel_name)
+        if self.metadata.get(key) == entry_status:
+            self.suppressed_writes += 1
+            return
+        if self.writer is not None:
+            self.writer.update(self.visit, model, entry_status=entry_status, panel_name=panel_name)
+        else:
+            options = dict(entry_status=entry_status)
+            if panel_name is not None:
+                options.update(panel_name=panel_name)
+            try:
+                self.visit.metadata_update_for_model(model, **options)
+            except ObjectDoesNotExist:
+                pass
+        if key in self.metadata:
+            self.metadata[key] = entry_status
+
+    @classmethod
+    def get_registered_subject_model(cls):
+        """Returns the registered subject model, looked up once."""
+        if cls._registered_subject_model is None:
+            cls._registered_subject_model = django_apps.get_app_config('edc_registration').model
+        return cls._registered_subject_model
+
+    @property
+    def registered_subject(self):
+        if not self._registered_subject_loaded:
+            model = self.get_registered_subject_model()
+            try:
+                self._registered_subject = model.objects.get(
+                    subject_identifier=self.visit.subject_identifier)
+            except model.DoesNotExist:
+                self._registered_subject = None
+            self._registered_subject_loaded = True
+        return self._registered_subject
+
+    def get_source_obj(self, source_model, plan=None):
+        """Returns the source model instance for the visit, the visit
+        itself if the source model is not a CRF, or None.
+
+        Pass the rule's compiled `plan` to use its resolved model."""
+        key = tuple(source_model)
+        try:
+            return self._source_objs[key]
+        except KeyError:
+            pass
+        if plan is not None:
+            model = plan.source_model
+            source_for_visit = plan.source_for_visit
+        else:
+            model = django_apps.get_model(*source_model)
+            source_for_visit = hasattr(model.objects, 'get_for_visit')
+        if source_for_visit:
+            try:
+                source_obj = model.objects.get_for_visit(self.visit)
+            except model.DoesNotExist:
+                source_obj = None
+        else:
+            source_obj = self.visit
+        self._source_objs[key] = source_obj
+        return source_obj
+
+    def get_source_qs(self, source_model, plan=None):
+        """Returns a lazy handle on all source model instances for the subject."""
+        key = tuple(source_model)
+        try:
+            return self._source_querysets[key]
+        except KeyError:
+            pass
+        model = plan.source_model if plan is not None else django_apps.get_model(*source_model)
+        source_qs = SourceQueryset(model, self.visit.subject_identifier)
+        self._source_querysets[key] = source_qs
+        return source_qs
+
+
+@contextmanager
+def visit_context(visit, context=None, **options):
+    """Yields the given context or, if None, a new context for the
+    visit that is discarded on exit."""
+    if context is not None:
+        yield context
+    else:
+        with VisitContext(visit, **options) as context:
+            yield context